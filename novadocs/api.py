@@ -0,0 +1,242 @@
+# api.py
+#
+# Headless HTTP API for NovaDocs, served next to the Gradio UI (mounted at /) by one uvicorn server.
+# It drives the same functions as the Gradio callbacks, so profiles, the indexes and the response
+# cache are shared with the UI. Ingest progress and per-agent answers stream as server-sent events:
+#
+#     python api.py
+#     curl -N -X POST localhost:7860/v1/profiles/Default/query -H "Content-Type: application/json" \
+#          -d '{"question": "What are the staking rewards?", "agents": ["General", "MasterAgent"]}'
+
+import json
+import os
+import shutil
+import tempfile
+import types
+import uuid
+from typing import Dict, List, Optional
+
+import anyio
+import gradio as gr
+import uvicorn
+from fastapi import FastAPI, File, HTTPException, UploadFile
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ConfigDict
+
+import contextualtickboxes as novadocs
+
+API_HOST = os.environ.get("NOVADOCS_API_HOST", "127.0.0.1")  # 0.0.0.0 serves other machines too
+API_PORT = int(os.environ.get("NOVADOCS_API_PORT", 7860))
+# Origins allowed to call the API from a browser, e.g. the Next.js front end in user-interface/
+CORS_ORIGINS = [origin for origin in os.environ.get("NOVADOCS_API_CORS_ORIGINS", "http://localhost:3000").split(",") if origin]
+UPLOAD_BLOCK_SIZE = 1 << 20
+
+# Profile settings the API can read and change; the documents and index are managed through ingest
+SETTINGS_FIELDS = ["agents", "decision_mode", "custom_text", "applicable_location", "applicable_entity", "use_legal_situational_context", "use_entity_context", "use_general_crypto_knowledge", "retrieval_mode", "agent_call_mode", "agent_models"]
+
+class ProfileRequest(BaseModel):
+    name: str
+
+class SettingsRequest(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    agents: Optional[List[str]] = None
+    decision_mode: Optional[str] = None
+    custom_text: Optional[str] = None
+    applicable_location: Optional[str] = None
+    applicable_entity: Optional[str] = None
+    use_legal_situational_context: Optional[bool] = None
+    use_entity_context: Optional[bool] = None
+    use_general_crypto_knowledge: Optional[bool] = None
+    retrieval_mode: Optional[str] = None
+    agent_call_mode: Optional[str] = None
+    agent_models: Optional[Dict[str, str]] = None
+
+class QueryRequest(BaseModel):
+    # Settings left out are taken from the profile, as the UI would show them. They only apply to
+    # this query and are never saved to the profile; use PATCH for that.
+    model_config = ConfigDict(extra="forbid")
+    question: str
+    agents: Optional[List[str]] = None
+    decision_mode: Optional[str] = None
+    custom_text: Optional[str] = None
+    applicable_location: Optional[str] = None
+    applicable_entity: Optional[str] = None
+    use_legal_situational_context: Optional[bool] = None
+    use_entity_context: Optional[bool] = None
+    use_general_crypto_knowledge: Optional[bool] = None
+    retrieval_mode: Optional[str] = None
+    agent_call_mode: Optional[str] = None
+    # A new query with the same session cancels the one still running, like a new Submit in the UI
+    session: Optional[str] = None
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def get_profile(profile_name):
+    if profile_name not in novadocs.profiles:
+        raise HTTPException(status_code=404, detail=f"Profile {profile_name} not found.")
+    return novadocs.profiles[profile_name]
+
+def profile_settings(profile_name):
+    profile = get_profile(profile_name)
+    with novadocs.profiles_lock:
+        settings = {field: profile[field] for field in SETTINGS_FIELDS}
+        settings["pdfs"] = {filename: dict(summary) for filename, summary in profile["processed_texts"].items()}
+    return dict(settings, name=profile_name)
+
+def validate_settings(settings):
+    agents = settings.get("agents")
+    if agents is not None and any(agent not in novadocs.priority_explanations for agent in agents):
+        raise HTTPException(status_code=400, detail=f"Unknown agent; choose from {list(novadocs.priority_explanations)}.")
+    if settings.get("retrieval_mode") not in (None, *novadocs.RETRIEVAL_MODES):
+        raise HTTPException(status_code=400, detail=f"retrieval_mode must be one of {novadocs.RETRIEVAL_MODES}.")
+    if settings.get("agent_call_mode") not in (None, *novadocs.AGENT_CALL_MODES):
+        raise HTTPException(status_code=400, detail=f"agent_call_mode must be one of {novadocs.AGENT_CALL_MODES}.")
+    if settings.get("agent_models") is not None and any(role not in novadocs.model_roles() for role in settings["agent_models"]):
+        raise HTTPException(status_code=400, detail=f"agent_models keys must be among {novadocs.model_roles()}.")
+
+async def stream_events(frames, to_events, on_close=None):
+    # Runs a synchronous generator (process_pdfs, ask_question) on a worker thread and streams the
+    # events each item produces. A client that disconnects abandons the pending item; on_close then
+    # lets the generator wind down (e.g. cancels the query).
+    try:
+        while True:
+            item = await anyio.to_thread.run_sync(next, frames, StopIteration, abandon_on_cancel=True)
+            if item is StopIteration:
+                break
+            for event in to_events(item):
+                yield event
+    finally:
+        if on_close is not None:
+            on_close()
+
+api = FastAPI(title="NovaDocs API")
+api.add_middleware(CORSMiddleware, allow_origins=CORS_ORIGINS, allow_methods=["*"], allow_headers=["*"])
+
+@api.get("/v1/profiles")
+def list_profiles():
+    with novadocs.profiles_lock:
+        return {"profiles": list(novadocs.profiles.keys())}
+
+@api.post("/v1/profiles", status_code=201)
+def create_profile(body: ProfileRequest):
+    if not body.name.strip() or body.name in (".", "..") or os.sep in body.name:
+        raise HTTPException(status_code=400, detail="Invalid profile name.")
+    if body.name in novadocs.profiles:
+        raise HTTPException(status_code=409, detail=f"Profile {body.name} already exists.")
+    novadocs.create_profile(body.name)
+    return profile_settings(body.name)
+
+@api.get("/v1/profiles/{profile_name}")
+def read_profile(profile_name: str):
+    return profile_settings(profile_name)
+
+@api.patch("/v1/profiles/{profile_name}")
+def update_profile(profile_name: str, body: SettingsRequest):
+    profile = get_profile(profile_name)
+    settings = body.model_dump(exclude_none=True)
+    validate_settings(settings)
+    if "agent_models" in settings:
+        settings["agent_models"] = novadocs.clean_agent_models(settings["agent_models"].items())
+    with novadocs.profiles_lock:
+        profile.update(settings)
+        if settings:
+            novadocs.save_profile(profile_name, *settings)
+    if "agent_models" in settings:
+        novadocs.warm_up_models(novadocs.profile_models(profile))
+    return profile_settings(profile_name)
+
+@api.delete("/v1/profiles/{profile_name}")
+def remove_profile(profile_name: str):
+    get_profile(profile_name)
+    _, message, _ = novadocs.delete_profile(profile_name, None)
+    return {"detail": message}
+
+@api.post("/v1/profiles/{profile_name}/pdfs")
+async def ingest(profile_name: str, files: List[UploadFile] = File(...), replace: bool = False):
+    # Adds the uploaded PDFs to the profile (replace=true makes them its only PDFs) and streams
+    # "status" events with the same progress messages as the UI, then "done" with the profile's PDFs
+    get_profile(profile_name)
+    # PDFs are kept in the profile under their file name, so the names in one upload must differ
+    filenames = [os.path.basename(upload.filename or "") for upload in files]
+    filenames = [filename if filename not in ("", ".", "..") else f"{uuid.uuid4().hex}.pdf" for filename in filenames]
+    repeated = sorted(set(filename for filename in filenames if filenames.count(filename) > 1))
+    if repeated:
+        raise HTTPException(status_code=400, detail=f"Several files are named {', '.join(repeated)}; rename them before uploading.")
+    upload_dir = tempfile.mkdtemp(prefix="novadocs-upload-")
+    try:
+        paths = []
+        for upload, filename in zip(files, filenames):
+            path = os.path.join(upload_dir, filename)
+            with open(path, "wb") as f:
+                while True:
+                    block = await upload.read(UPLOAD_BLOCK_SIZE)
+                    if not block:
+                        break
+                    f.write(block)
+            paths.append(types.SimpleNamespace(name=path))
+    except BaseException:
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        raise
+
+    def to_events(message):
+        yield sse("status", {"message": message})
+
+    async def events():
+        try:
+            async for event in stream_events(novadocs.process_pdfs(paths, profile_name, keep_existing=not replace), to_events):
+                yield event
+            if profile_name in novadocs.profiles:
+                yield sse("done", profile_settings(profile_name)["pdfs"])
+        finally:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@api.post("/v1/profiles/{profile_name}/query")
+def query(profile_name: str, body: QueryRequest):
+    # Streams an "agent" event with the text so far whenever an agent's answer changes, then "done"
+    # with the final answer of every selected agent (MasterAgent and Maxed included)
+    profile = get_profile(profile_name)
+    if not profile["processed_texts"]:
+        raise HTTPException(status_code=409, detail="Please process PDFs first before asking questions.")
+    options = body.model_dump(exclude_none=True)
+    validate_settings(options)
+    settings = dict(profile, **options)
+    session = f"api-{body.session or uuid.uuid4().hex}"
+    frames = novadocs.ask_question(
+        body.question, settings["agents"], settings["decision_mode"], settings["custom_text"],
+        settings["applicable_location"], settings["applicable_entity"], settings["use_legal_situational_context"],
+        settings["use_entity_context"], settings["use_general_crypto_knowledge"], profile_name,
+        types.SimpleNamespace(session_hash=session), save_settings=False,
+        retrieval_mode=settings["retrieval_mode"], agent_call_mode=settings["agent_call_mode"]
+    )
+    priority_list = list(novadocs.priority_explanations.keys())
+    results = {}
+
+    def to_events(frame):
+        # Frames hold a string for every box that changed and an empty update for the rest
+        for priority, value in zip(priority_list, frame):
+            if isinstance(value, str) and results.get(priority) != value:
+                results[priority] = value
+                yield sse("agent", {"agent": priority, "text": value})
+
+    async def events():
+        async for event in stream_events(frames, to_events, lambda: novadocs.cancel_query(session)):
+            yield event
+        yield sse("done", {"results": {priority: text for priority, text in results.items() if text != "Not selected"}})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+novadocs.demo.queue(default_concurrency_limit=novadocs.QUEUE_CONCURRENCY)
+app = gr.mount_gradio_app(api, novadocs.demo, path="/")
+
+if __name__ == "__main__":
+    if novadocs.METRICS_PORT:
+        try:
+            novadocs.start_metrics_server(novadocs.METRICS_PORT, novadocs.METRICS_HOST)
+            print(f"Serving metrics on port {novadocs.METRICS_PORT} at /metrics")
+        except OSError as e:
+            print(f"Could not start the metrics endpoint on port {novadocs.METRICS_PORT}: {str(e)}")
+    uvicorn.run(app, host=API_HOST, port=API_PORT)
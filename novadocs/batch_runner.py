@@ -0,0 +1,162 @@
+# batch_runner.py
+#
+# Runs a checklist of questions against a NovaDocs profile without the UI, a bounded number at a
+# time, through the same ask_question the Submit button uses (so the profile's index, embeddings and
+# response cache are reused across questions). Every finished question is appended to a JSONL file
+# straight away; running the same command again skips the questions already answered there.
+#
+#     python batch_runner.py --profile "Project X" --questions checklist.jsonl --output answers.jsonl
+#
+# The questions file holds one JSON object per line: {"question": ..., "agents": [...]} plus, optionally,
+# an "id" and any of decision_mode, custom_text, applicable_location, applicable_entity,
+# use_legal_situational_context, use_entity_context and use_general_crypto_knowledge. Anything left out
+# is taken from the profile, and nothing a question uses is saved back to it. A line that isn't JSON
+# is read as a question for the --agents. A question any agent failed on is retried on the next run.
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+import types
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
+QUESTION_SETTINGS = ["decision_mode", "custom_text", "applicable_location", "applicable_entity", "use_legal_situational_context", "use_entity_context", "use_general_crypto_knowledge"]
+
+def question_id(item):
+    # Stable across runs so a resumed checklist matches its earlier answers
+    if item.get("id") is not None:
+        return str(item["id"])
+    key = json.dumps([item["question"], item.get("agents"), {field: item.get(field) for field in QUESTION_SETTINGS}], sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+def load_questions(path, default_agents):
+    questions = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                item = line
+            if isinstance(item, str):
+                item = {"question": item}
+            if not isinstance(item, dict) or not item.get("question"):
+                raise ValueError(f"{path}:{line_number}: expected a question or a JSON object with a \"question\"")
+            item.setdefault("agents", default_agents)
+            item["id"] = question_id(item)
+            item["line"] = line_number
+            questions.append(item)
+    return questions
+
+def load_answered(path):
+    # Ids already answered in an earlier run; failed questions are retried
+    answered = set()
+    if not os.path.exists(path):
+        return answered
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # A line cut off when the previous run was interrupted
+            if "error" not in record:
+                answered.add(record["id"])
+    return answered
+
+def run_question(app, profile_name, item, session):
+    profile = app.profiles[profile_name]
+    settings = {field: item.get(field, profile[field]) for field in QUESTION_SETTINGS}
+    priority_list = list(app.priority_explanations.keys())
+    results = {}
+    started = time.perf_counter()
+    for frame in app.ask_question(
+        item["question"], item["agents"], settings["decision_mode"], settings["custom_text"],
+        settings["applicable_location"], settings["applicable_entity"], settings["use_legal_situational_context"],
+        settings["use_entity_context"], settings["use_general_crypto_knowledge"], profile_name,
+        types.SimpleNamespace(session_hash=session), save_settings=False
+    ):
+        # Frames hold a string for every box that changed and an empty update for the rest
+        for priority, value in zip(priority_list, frame):
+            if isinstance(value, str):
+                results[priority] = value
+    record = {
+        "id": item["id"],
+        "line": item["line"],
+        "question": item["question"],
+        "agents": item["agents"],
+        "results": {priority: text for priority, text in results.items() if text != "Not selected"},
+        "seconds": round(time.perf_counter() - started, 3),
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    }
+    # Any agent that failed fails the question, so a rerun asks it again
+    errors = sorted(f"{priority}: {text}" for priority, text in record["results"].items() if app.failed_answer(text))
+    if errors:
+        record["error"] = errors[0]
+    return record
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a file of questions against a NovaDocs profile")
+    parser.add_argument("--profile", required=True, help="Profile whose processed PDFs the questions are asked against")
+    parser.add_argument("--questions", required=True, help="JSONL file of questions (or one plain question per line)")
+    parser.add_argument("--output", required=True, help="JSONL file the answers are appended to; questions already in it are skipped")
+    parser.add_argument("--agents", default="General,MasterAgent", help="Comma-separated agents for questions that don't list their own")
+    parser.add_argument("--concurrency", type=int, default=2, help="Questions in flight at once; agent streams are also capped by OLLAMA_NUM_PARALLEL")
+    parser.add_argument("--ollama", default=None, help="Ollama server address (default: the app's)")
+    args = parser.parse_args()
+
+    questions = load_questions(args.questions, [agent.strip() for agent in args.agents.split(",") if agent.strip()])
+    answered = load_answered(args.output)
+    pending = [item for item in questions if item["id"] not in answered]
+    print(f"{len(questions)} question(s), {len(questions) - len(pending)} already answered in {args.output}")
+    if not pending:
+        return
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import contextualtickboxes as app
+    if args.ollama:
+        app.ollama_server = args.ollama
+    if args.profile not in app.profiles or not app.profiles[args.profile]["processed_texts"]:
+        sys.exit(f"Profile {args.profile} not found or has no processed PDFs.")
+    unknown = sorted(set(agent for item in pending for agent in item["agents"] if agent not in app.priority_explanations))
+    if unknown:
+        sys.exit(f"Unknown agent(s): {', '.join(unknown)}; choose from {', '.join(app.priority_explanations)}.")
+
+    done = 0
+    failed = 0
+    executor = ThreadPoolExecutor(max_workers=max(1, args.concurrency), thread_name_prefix="novadocs-batch")
+    futures = {}
+    try:
+        with open(args.output, "a", encoding="utf-8") as output:
+            for item in pending:
+                futures[executor.submit(run_question, app, args.profile, item, f"batch-{item['id']}")] = item
+            while futures:
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    item = futures.pop(future)
+                    try:
+                        record = future.result()
+                    except Exception as e:
+                        record = {"id": item["id"], "line": item["line"], "question": item["question"], "agents": item["agents"], "error": str(e)}
+                    output.write(json.dumps(record) + "\n")
+                    output.flush()  # Every answer is on disk before the next one, so an interrupted run loses nothing
+                    done += 1
+                    failed += "error" in record
+                    status = f"failed: {record['error']}" if "error" in record else f"{record['seconds']:.1f} s"
+                    print(f"[{done}/{len(pending)}] line {item['line']}: {status}")
+    except KeyboardInterrupt:
+        print("Interrupted; cancelling the questions in flight. Run the same command again to resume.")
+        for future, item in futures.items():
+            future.cancel()
+            app.cancel_query(f"batch-{item['id']}")
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        app.profile_store.flush()
+    print(f"Answered {done - failed} question(s), {failed} failed; results in {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+# benchmark.py
+#
+# Offline benchmark for NovaDocs: builds a synthetic PDF corpus, starts a stand-in for the Ollama API
+# with configurable latency and token rate, and times ingest, retrieval and queries through the same
+# functions the Gradio callbacks use. Results are written as JSON so runs can be compared across commits:
+#
+#     python benchmark.py --documents 20 --pages 30 --output before.json
+#     python benchmark.py --documents 20 --pages 30 --output after.json --compare before.json
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+VOCABULARY = (
+    "token supply staking rewards validator governance proposal treasury bridge liquidity pool audit "
+    "smart contract vesting schedule emission inflation burn fee market maker custody wallet exchange "
+    "regulation compliance license jurisdiction disclosure risk exploit oracle collateral lending yield "
+    "protocol upgrade roadmap mainnet testnet consensus throughput latency node operator slashing"
+).split()
+
+QUESTIONS = [
+    "What are the staking rewards and how are they distributed?",
+    "Which regulatory risks does the project mention?",
+    "How is the treasury governed?",
+    "What does the audit say about the bridge?",
+    "Describe the token vesting schedule."
+]
+
+def synthetic_page(rng, words):
+    sentences = []
+    while sum(len(sentence.split()) for sentence in sentences) < words:
+        sentence = " ".join(rng.choice(VOCABULARY) for _ in range(rng.randint(8, 20)))
+        sentences.append(f"{sentence.capitalize()} {rng.randint(1, 10000)}.")
+    return " ".join(sentences)
+
+def write_pdf(path, pages):
+    # Minimal single-font PDF with one text stream per page; enough for PyPDF2 to extract the text back
+    objects = [b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    contents = []
+    for text in pages:
+        lines = [text[i:i + 90].replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") for i in range(0, len(text), 90)]
+        stream = ("BT /F1 10 Tf 40 800 Td 12 TL " + " ".join(f"({line}) '" for line in lines) + " ET").encode("latin-1", errors="replace")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        contents.append(len(objects))
+    pages_id = len(objects) + len(pages) + 1
+    kids = []
+    for content_id in contents:
+        objects.append(b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 612 842] /Contents %d 0 R /Resources << /Font << /F1 1 0 R >> >> >>" % (pages_id, content_id))
+        kids.append(len(objects))
+    objects.append(b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % kid for kid in kids), len(kids)))
+    objects.append(b"<< /Type /Catalog /Pages %d 0 R >>" % pages_id)
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1) + b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    data += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, len(objects), xref)
+    with open(path, "wb") as f:
+        f.write(data)
+
+def generate_corpus(directory, documents, pages, words_per_page, seed=0):
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for number in range(documents):
+        path = os.path.join(directory, f"whitepaper_{number:03d}.pdf")
+        write_pdf(path, [synthetic_page(rng, words_per_page) for _ in range(pages)])
+        paths.append(path)
+    return paths
+
+class FakeOllama(BaseHTTPRequestHandler):
+    # Stand-in for the Ollama endpoints NovaDocs calls. /api/chat waits first_token_latency seconds,
+    # then streams response_tokens tokens at tokens_per_second; /api/embed returns deterministic vectors.
+    # Streams use chunked transfer encoding like Ollama, so every line reaches the client as it is sent.
+    protocol_version = "HTTP/1.1"
+    first_token_latency = 0.2
+    tokens_per_second = 50.0
+    response_tokens = 60
+    embedding_dimension = 64
+
+    def log_message(self, *args):
+        pass
+
+    def send_json_line(self, payload):
+        data = json.dumps(payload).encode("utf-8") + b"\n"
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path == "/api/embed":
+            inputs = body.get("input", [])
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            embeddings = []
+            for text in inputs:
+                seed = hashlib.sha256(text.encode("utf-8")).digest()
+                embeddings.append([(seed[i % len(seed)] - 127.5) / 127.5 for i in range(self.embedding_dimension)])
+            data = json.dumps({"embeddings": embeddings}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        if self.path not in ("/api/chat", "/api/generate"):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        prompt_tokens = len(json.dumps(body)) // 4
+        started = time.monotonic()
+        time.sleep(self.first_token_latency)
+        prompt_eval_ns = int((time.monotonic() - started) * 1e9)
+        started = time.monotonic()
+        for number in range(self.response_tokens):
+            self.send_json_line({"message": {"role": "assistant", "content": f"- point {number} "}, "done": False})
+            time.sleep(1 / self.tokens_per_second)
+        self.send_json_line({"done": True, "prompt_eval_count": prompt_tokens, "prompt_eval_duration": prompt_eval_ns, "eval_count": self.response_tokens, "eval_duration": int((time.monotonic() - started) * 1e9)})
+        self.wfile.write(b"0\r\n\r\n")
+
+def start_fake_ollama(first_token_latency, tokens_per_second, response_tokens):
+    FakeOllama.first_token_latency = first_token_latency
+    FakeOllama.tokens_per_second = tokens_per_second
+    FakeOllama.response_tokens = response_tokens
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOllama)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def summarize(values):
+    return {"runs": len(values), "mean": sum(values) / len(values), "p50": percentile(values, 0.5), "p95": percentile(values, 0.95), "max": max(values)}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+class Upload:
+    # What Gradio passes to process_pdfs for each uploaded file
+    def __init__(self, path):
+        self.name = path
+
+def benchmark_ingest(app, profile_name, paths, total_pages):
+    results = {}
+    for label in ("cold", "warm"):
+        started = time.perf_counter()
+        messages = list(app.process_pdfs([Upload(path) for path in paths], profile_name))
+        elapsed = time.perf_counter() - started
+        if not messages or not messages[-1].startswith("Processed"):
+            raise RuntimeError(f"Ingest failed: {messages[-1] if messages else 'no output'}")
+        results[label] = {"seconds": elapsed, "documents_per_second": len(paths) / elapsed, "pages_per_second": total_pages / elapsed}
+        print(f"ingest ({label}): {elapsed:.2f} s, {total_pages / elapsed:.1f} pages/s")
+    return results
+
+def benchmark_retrieval(app, profile_name, repeats):
+    profile = app.profiles[profile_name]
+    results = {}
+    modes = ["Keyword"] + (["Semantic", "Hybrid"] if app.semantic_available() else [])
+    for mode in modes:
+        vectors = app.get_vector_index(profile_name) if mode != "Keyword" else None
+        if vectors is not None:
+            vectors.sync(profile["index"], app.embed_texts, app.EMBED_MODEL)
+        timings = []
+        for run in range(repeats):
+            for question in QUESTIONS:
+                started = time.perf_counter()
+                app.get_relevant_chunk(question, profile["index"], retrieval_mode=mode, vectors=vectors)
+                timings.append((time.perf_counter() - started) * 1000)
+        results[mode] = summarize(timings)
+        print(f"retrieval ({mode}): p50 {results[mode]['p50']:.2f} ms, p95 {results[mode]['p95']:.2f} ms")
+    return results
+
+def benchmark_queries(app, profile_name, agent_sets, repeats):
+    # Time to first token is the first frame in which any box shows generated text
+    placeholders = ("Generating...", "Not selected")
+    results = {}
+    for label, agents in agent_sets.items():
+        first_token = []
+        end_to_end = []
+        for run in range(repeats):
+            app.response_cache.invalidate(profile_name)  # Every run goes to the (fake) model
+            question = QUESTIONS[run % len(QUESTIONS)]
+            started = time.perf_counter()
+            first = None
+            for frame in app.ask_question(question, agents, "Evaluate Project", "", "", "", False, False, False, profile_name):
+                if first is None and any(isinstance(value, str) and value not in placeholders for value in frame):
+                    first = time.perf_counter() - started
+            end_to_end.append(time.perf_counter() - started)
+            first_token.append(first if first is not None else end_to_end[-1])
+        results[label] = {"agents": agents, "time_to_first_token": summarize(first_token), "end_to_end": summarize(end_to_end)}
+        print(f"ask_question ({label}): first token p50 {results[label]['time_to_first_token']['p50']:.2f} s, end to end p50 {results[label]['end_to_end']['p50']:.2f} s")
+    return results
+
+def compare(results, baseline_path):
+    # Prints current / baseline for every number both runs share; below 1.0 is faster for timings
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)
+
+    def walk(current, previous, path):
+        if isinstance(current, dict) and isinstance(previous, dict):
+            for key in current:
+                if key in previous:
+                    walk(current[key], previous[key], f"{path}.{key}" if path else key)
+        elif isinstance(current, (int, float)) and isinstance(previous, (int, float)) and not isinstance(current, bool) and previous:
+            print(f"{path}: {previous:.4g} -> {current:.4g} ({current / previous:.2f}x)")
+
+    print(f"Compared with {baseline_path} (commit {baseline.get('commit')}):")
+    walk(results["results"], baseline.get("results", {}), "")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline NovaDocs benchmark")
+    parser.add_argument("--documents", type=int, default=10, help="PDFs in the synthetic corpus")
+    parser.add_argument("--pages", type=int, default=20, help="Pages per PDF")
+    parser.add_argument("--words-per-page", type=int, default=400)
+    parser.add_argument("--first-token-latency", type=float, default=0.2, help="Seconds the fake model waits before its first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="Token rate of the fake model, per stream")
+    parser.add_argument("--response-tokens", type=int, default=60, help="Tokens in every fake answer")
+    parser.add_argument("--repeats", type=int, default=3, help="Runs per query measurement")
+    parser.add_argument("--output", default=None, help="Results file (default: benchmark_results/<timestamp>-<commit>.json)")
+    parser.add_argument("--compare", default=None, help="Earlier results file to compare against")
+    parser.add_argument("--keep-workdir", action="store_true", help="Keep the scratch directory with the corpus, caches and profiles")
+    args = parser.parse_args()
+
+    commit = git_commit()
+    output = os.path.abspath(args.output or os.path.join("benchmark_results", f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{commit or 'unknown'}.json"))
+    baseline = os.path.abspath(args.compare) if args.compare else None
+    server = start_fake_ollama(args.first_token_latency, args.tokens_per_second, args.response_tokens)
+
+    # NovaDocs keeps its profiles and caches relative to the working directory, so the benchmark
+    # runs in a scratch directory and never touches real profiles
+    work_dir = tempfile.mkdtemp(prefix="novadocs-benchmark-")
+    started_in = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import contextualtickboxes as app
+        app.ollama_server = f"http://127.0.0.1:{server.server_port}"
+
+        print(f"Generating {args.documents} PDF(s) of {args.pages} pages in {work_dir}")
+        paths = generate_corpus(os.path.join(work_dir, "corpus"), args.documents, args.pages, args.words_per_page)
+        profile_name = "Benchmark"
+        app.create_profile(profile_name)
+
+        specialists = list(app.priority_explanations.keys())[2:]
+        agent_sets = {"1 agent": ["General"], "5 agents": specialists[:5], "all agents": ["Maxed"]}
+        results = {
+            "commit": commit,
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "config": dict(vars(args), max_concurrent_agents=app.MAX_CONCURRENT_AGENTS),
+            "results": {
+                "ingest": benchmark_ingest(app, profile_name, paths, args.documents * args.pages),
+                "retrieval_ms": benchmark_retrieval(app, profile_name, args.repeats),
+                "ask_question_seconds": benchmark_queries(app, profile_name, agent_sets, args.repeats)
+            }
+        }
+        # Per-stage histograms collected by the app while the benchmark ran
+        results["results"]["stages"] = {f"{metric} {series}": {"unit": unit, "count": count, "mean": mean, "p50": p50, "p95": p95} for metric, series, unit, count, mean, p50, p95 in app.diagnostics_rows()}
+        app.profile_store.flush()
+
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {output}")
+        if baseline:
+            compare(results, baseline)
+    finally:
+        server.shutdown()
+        os.chdir(started_in)
+        if args.keep_workdir:
+            print(f"Kept the scratch directory {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# blob_store.py
+
+import os
+import shutil
+import tempfile
+from pdf_extract import file_sha256
+
+class BlobStore:
+    # Content-addressed file store: every PDF is kept once under its SHA-256, however many
+    # profiles reference it. Profiles only hold the hash, and the bytes stay on disk until a PDF is
+    # extracted again, so nothing is read into memory at start-up.
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], f"{digest}.pdf")
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def open(self, digest):
+        return open(self.path(digest), "rb")
+
+    def put_file(self, source_path, digest=None, move=False):
+        digest = digest or file_sha256(source_path)
+        blob_path = self.path(digest)
+        if os.path.exists(blob_path):
+            if move:
+                os.remove(source_path)
+            return digest
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        # A temporary name of its own, so concurrent puts of the same PDF don't write over each other
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{digest}.", suffix=".tmp", dir=os.path.dirname(blob_path))
+        os.close(fd)
+        try:
+            if move:
+                shutil.move(source_path, tmp_path)
+            else:
+                shutil.copyfile(source_path, tmp_path)
+            os.replace(tmp_path, blob_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return digest
+
+    def collect_garbage(self, referenced):
+        # Removes blobs no profile refers to any more
+        removed = 0
+        for prefix in os.listdir(self.root):
+            prefix_dir = os.path.join(self.root, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for blob_name in os.listdir(prefix_dir):
+                if blob_name.endswith(".tmp"):
+                    continue  # A put still in progress
+                digest = blob_name.split(".")[0]
+                if digest not in referenced:
+                    os.remove(os.path.join(prefix_dir, blob_name))
+                    removed += 1
+        return removed
@@ -2,145 +2,292 @@ import gradio as gr
 import requests
 import json
 import re
-from PyPDF2 import PdfReader
 import os
 import pickle
 import shutil
+import queue
+import atexit
+import time
+import threading
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from functools import partial
 from datetime import datetime
+from doc_index import BM25Index, INDEX_VERSION, estimate_tokens, format_chunk, pack_chunks
+from pdf_extract import extract_file, extract_pdfs, extracted_texts, file_sha256
+from profile_store import ProfileStore
+from blob_store import BlobStore
+from history_store import HistoryStore
+from llm_cache import ResponseCache, cache_key
+from partial_json import partial_json_fields
+from vector_index import VectorIndex, ollama_embed, semantic_available
+from metrics import HISTOGRAMS, observe_ollama_stats, stage_seconds, start_metrics_server, timed
 
 ollama_server = "http://localhost:11434"  # Default Ollama server address
-processed_texts = {}
-CHUNK_SIZE = 4000  # Adjust this value based on your model's context window
-history = []
-current_profile = None
+CHUNK_TOKENS = 350  # Target chunk size; chunks are cut at sentence boundaries
+CHUNK_OVERLAP_TOKENS = 50  # Trailing sentences repeated at the start of the next chunk
+CONTEXT_TOKEN_BUDGET = 1500  # Retrieved context per LLM call; raise with the model's context window (num_ctx)
+RETRIEVAL_CANDIDATES = 50  # Ranked chunks considered when packing the context budget
+# Chunks at least this similar (estimated Jaccard over word 5-grams) to one already indexed are collapsed into it
+DUPLICATE_CHUNK_SIMILARITY = 0.8
+# Agents streamed from Ollama at the same time; keep this in line with the server's OLLAMA_NUM_PARALLEL
+MAX_CONCURRENT_AGENTS = max(1, int(os.environ.get("OLLAMA_NUM_PARALLEL", 4)))
+OLLAMA_KEEP_ALIVE_SECONDS = 30 * 60  # Keeps the model and its cached prompt prefix loaded between agents and queries
+OLLAMA_KEEP_ALIVE = f"{OLLAMA_KEEP_ALIVE_SECONDS}s"  # The same duration in the form Ollama's keep_alive takes
+# Default model tiers: specialist agents and Whole document notes can use a small model (e.g. llama3.2:1b)
+# and the MasterAgent/Maxed synthesis a larger one. Each profile can route any agent to its own model.
+SPECIALIST_MODEL = os.environ.get("NOVADOCS_SPECIALIST_MODEL", "llama3.2")
+SYNTHESIS_MODEL = os.environ.get("NOVADOCS_SYNTHESIS_MODEL", "llama3.2")
+NOTES_MODEL_ROLE = "Whole document notes"  # Model table row for the map and reduce calls
+UI_FRAME_INTERVAL = 0.1  # Seconds between output box updates while agents stream
+CANCELLED_MESSAGE = "Cancelled"  # Shown in boxes whose query was superseded or stopped
+# How the answers of a failed query or agent start, for callers that check an answer (batch_runner)
+FAILED_ANSWER_PREFIXES = (
+    "Please process PDFs first",
+    "An error occurred while processing your question",
+    "Error communicating with Ollama API",
+    "Error decoding JSON response",
+    "An unexpected error occurred",
+    "Error generating MasterAgent output",
+    "No answer returned for this agent",
+    CANCELLED_MESSAGE
+)
+# Semantic and Hybrid need numpy and an Ollama embedding model. Whole document reads every page
+# through map-reduce instead of retrieving the best chunks.
+RETRIEVAL_MODES = ["Keyword", "Semantic", "Hybrid", "Whole document"]
+SEMANTIC_RETRIEVAL_MODES = ("Semantic", "Hybrid")
+# Single JSON call sends the context once and asks for one JSON field per selected agent (needs Ollama 0.5+)
+AGENT_CALL_MODES = ["Separate calls", "Single JSON call"]
+EMBED_MODEL = "nomic-embed-text"
+HYBRID_LEXICAL_WEIGHT = 0.3  # Share of the BM25 score in Hybrid mode
+MAP_SECTION_TOKENS = 2000  # Document text per "map" call in Whole document mode
+REDUCE_INPUT_TOKENS = 3000  # Notes merged per "reduce" call
+MAP_REDUCE_CACHE_TAG = "map-reduce"  # Map and reduce results are keyed by their input text, so they outlive PDF changes
+HISTORY_PAGE_SIZE = 10  # History entries loaded per page in the History tab
+RESPONSE_CACHE_DIR = "response_cache"
+RESPONSE_CACHE_MEMORY_ENTRIES = 256
+RESPONSE_CACHE_DISK_BYTES = 100 * 1024 * 1024
+# Prometheus metrics are served on this port at /metrics; 0 turns the endpoint off
+METRICS_PORT = int(os.environ.get("NOVADOCS_METRICS_PORT", 9464))
+METRICS_HOST = os.environ.get("NOVADOCS_METRICS_HOST", "127.0.0.1")  # 0.0.0.0 lets other machines scrape it
+# Gradio events handled at once across all sessions; each session keeps its selected profile in gr.State
+QUEUE_CONCURRENCY = max(1, int(os.environ.get("NOVADOCS_QUEUE_CONCURRENCY", 16)))
+INGEST_CHECKPOINT_SECONDS = 30  # How often a long ingest saves the documents indexed so far
 profiles = {}
+# Guards the profiles dict and the data inside each profile, which every session shares. Held for
+# index lookups and updates only, never while PDFs are extracted or agents generate.
+profiles_lock = threading.RLock()
 
 # Directory to store profiles
 PROFILES_DIR = "profiles"
 
 os.makedirs(PROFILES_DIR, exist_ok=True)
 
+# PDFs are stored once by content hash and shared between profiles
+pdf_blobs = BlobStore("pdf_blobs")
+ingesting_pdfs = Counter()  # digest -> ingests storing that PDF that haven't recorded it in their profile yet
+
 def create_default_profile():
     return {
-        "pdfs": {},
+        "pdfs": {},  # filename -> SHA-256 of the PDF in pdf_blobs
         "agents": ["General"],
         "decision_mode": "Make Decision",
         "custom_text": "",
         "last_question": "",
-        "processed_texts": {},
+        "processed_texts": {},  # filename -> {"pages", "words"}; the text itself is in extracted_texts
+        "index": BM25Index(chunk_tokens=CHUNK_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS, text_store=extracted_texts, duplicate_threshold=DUPLICATE_CHUNK_SIMILARITY),
         "applicable_location": "",
         "applicable_entity": "",
         "use_legal_situational_context": False,
         "use_entity_context": False,
-        "use_general_crypto_knowledge": False
+        "use_general_crypto_knowledge": False,
+        "retrieval_mode": "Keyword",
+        "agent_call_mode": "Separate calls",
+        "agent_models": {}  # agent (or NOTES_MODEL_ROLE) -> Ollama model; unlisted ones use the default tier
     }
 
+# Every persisted profile field; PDFs themselves live in the blob store and are referenced by hash
+PROFILE_FIELDS = ["pdfs", "agents", "decision_mode", "custom_text", "last_question", "processed_texts", "index", "applicable_location", "applicable_entity", "use_legal_situational_context", "use_entity_context", "use_general_crypto_knowledge", "retrieval_mode", "agent_call_mode", "agent_models"]
+
+profile_store = ProfileStore(os.path.join(PROFILES_DIR, "profiles.db"))
+atexit.register(profile_store.flush)
+
+def import_legacy_profiles():
+    # Profiles saved by older versions as a single profile_data.pkl are copied into the store once
+    known_profiles = set(profile_store.profile_names())
+    for profile_name in os.listdir(PROFILES_DIR):
+        profile_data_path = os.path.join(PROFILES_DIR, profile_name, "profile_data.pkl")
+        if profile_name in known_profiles or not os.path.exists(profile_data_path):
+            continue
+        try:
+            with open(profile_data_path, "rb") as f:
+                profile_data = pickle.load(f)
+            for field, value in profile_data.items():
+                if field in PROFILE_FIELDS:
+                    profile_store.set(profile_name, field, value)
+            print(f"Imported legacy profile {profile_name}")
+        except Exception as e:
+            print(f"Error importing legacy profile {profile_name}: {str(e)}")
+    profile_store.flush()
+
 def load_profiles():
-    global profiles
-    profiles = {}  # Reset profiles dictionary
+    with profiles_lock:
+        profiles.clear()  # Reset in place so every session sees the reloaded profiles
+        _load_profiles()
+
+def _load_profiles():
     if not os.path.exists(PROFILES_DIR):
         os.makedirs(PROFILES_DIR)
         print(f"Created profiles directory: {PROFILES_DIR}")
     
+    import_legacy_profiles()
+    for profile_name in profile_store.profile_names():
+        profiles[profile_name] = create_default_profile()
+        try:
+            profiles[profile_name].update(profile_store.load(profile_name))
+        except Exception as e:
+            print(f"Error loading profile {profile_name}: {str(e)}")
+            profiles[profile_name] = create_default_profile()
+        
+        # Older versions kept a copy of each PDF in the profile folder; move them into the blob store
+        pdf_dir = os.path.join(PROFILES_DIR, profile_name, "pdfs")
+        if os.path.exists(pdf_dir):
+            for pdf_name in os.listdir(pdf_dir):
+                profiles[profile_name]["pdfs"][pdf_name] = pdf_blobs.put_file(os.path.join(pdf_dir, pdf_name), move=True)
+            os.rmdir(pdf_dir)
+            save_profile(profile_name, "pdfs")
+        
+        # Older versions kept each document's full text in the profile; it now lives in the text store
+        processed_texts = profiles[profile_name]["processed_texts"]
+        legacy_texts = {filename: text for filename, text in processed_texts.items() if isinstance(text, str)}
+        for filename, text in legacy_texts.items():
+            digest = profiles[profile_name]["pdfs"].get(filename)
+            if digest is None:
+                del processed_texts[filename]
+                continue
+            if not extracted_texts.exists(digest):
+                extracted_texts.put(digest, [text])
+            processed_texts[filename] = document_summary(extracted_texts.iter_pages(digest))
+        if legacy_texts:
+            save_profile(profile_name, "processed_texts")
+        
+        # Profiles saved before the current index layout get theirs rebuilt from the extraction cache
+        index = profiles[profile_name]["index"]
+        if getattr(index, "version", 1) != INDEX_VERSION or (profiles[profile_name]["processed_texts"] and not len(index)):
+            profiles[profile_name]["index"] = rebuild_index(profiles[profile_name])
+            save_profile(profile_name, "index")
+    
     for profile_name in os.listdir(PROFILES_DIR):
-        profile_path = os.path.join(PROFILES_DIR, profile_name)
-        if os.path.isdir(profile_path):
-            profile_data_path = os.path.join(profile_path, "profile_data.pkl")
-            if os.path.exists(profile_data_path):
-                try:
-                    with open(profile_data_path, "rb") as f:
-                        profile_data = pickle.load(f)
-                        profiles[profile_name] = profile_data
-                    
-                    # Ensure all required keys exist
-                    required_keys = ["pdfs", "agents", "decision_mode", "custom_text", "last_question", "processed_texts", "applicable_location", "applicable_entity", "use_legal_situational_context", "use_entity_context", "use_general_crypto_knowledge"]
-                    for key in required_keys:
-                        if key not in profiles[profile_name]:
-                            profiles[profile_name][key] = {} if key == "pdfs" or key == "processed_texts" else ""
-                    
-                    # Load PDFs
-                    pdf_dir = os.path.join(profile_path, "pdfs")
-                    if os.path.exists(pdf_dir):
-                        for pdf_name in os.listdir(pdf_dir):
-                            pdf_path = os.path.join(pdf_dir, pdf_name)
-                            if os.path.exists(pdf_path):
-                                with open(pdf_path, "rb") as f:
-                                    profiles[profile_name]["pdfs"][pdf_name] = f.read()
-                            else:
-                                print(f"Warning: PDF file not found: {pdf_path}")
-                except Exception as e:
-                    print(f"Error loading profile {profile_name}: {str(e)}")
-                    profiles[profile_name] = create_default_profile()
-            else:
-                print(f"Warning: profile data file not found for {profile_name}")
-                profiles[profile_name] = create_default_profile()
+        if os.path.isdir(os.path.join(PROFILES_DIR, profile_name)) and profile_name not in profiles:
+            print(f"Warning: profile data not found for {profile_name}")
+            profiles[profile_name] = create_default_profile()
+            save_profile(profile_name)
     
     if not profiles:
         print("No profiles found. Creating a default profile.")
         profiles["Default"] = create_default_profile()
         save_profile("Default")
     
+    # Migrations are written out now rather than after the debounce: extraction workers start from a
+    # process that imports this module again, and it should load the migrated profiles, not redo them
+    profile_store.flush()
     print(f"Loaded profiles: {list(profiles.keys())}")
 
-def save_profile(profile_name):
-    profile_path = os.path.join(PROFILES_DIR, profile_name)
-    if not os.path.exists(profile_path):
-        os.makedirs(profile_path)
-    
-    # Save all profile data
-    profile_data = {
-        "agents": profiles[profile_name]["agents"],
-        "decision_mode": profiles[profile_name]["decision_mode"],
-        "custom_text": profiles[profile_name]["custom_text"],
-        "last_question": profiles[profile_name]["last_question"],
-        "processed_texts": profiles[profile_name]["processed_texts"],
-        "applicable_location": profiles[profile_name]["applicable_location"],
-        "applicable_entity": profiles[profile_name]["applicable_entity"],
-        "use_legal_situational_context": profiles[profile_name]["use_legal_situational_context"],
-        "use_entity_context": profiles[profile_name]["use_entity_context"],
-        "use_general_crypto_knowledge": profiles[profile_name]["use_general_crypto_knowledge"]
-    }
-    with open(os.path.join(profile_path, "profile_data.pkl"), "wb") as f:
-        pickle.dump(profile_data, f)
-    
-    # Save PDFs
-    pdf_dir = os.path.join(profile_path, "pdfs")
-    if not os.path.exists(pdf_dir):
-        os.makedirs(pdf_dir)
-    for pdf_name, pdf_content in profiles[profile_name]["pdfs"].items():
-        with open(os.path.join(pdf_dir, pdf_name), "wb") as f:
-            f.write(pdf_content)
+def document_summary(pages):
+    # pages can be any iterable, e.g. extracted_texts.iter_pages
+    summary = {"pages": 0, "words": 0}
+    for page in pages:
+        summary["pages"] += 1
+        summary["words"] += len(page.split())
+    return summary
+
+def rebuild_index(profile):
+    index = BM25Index(chunk_tokens=CHUNK_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS, text_store=extracted_texts, duplicate_threshold=DUPLICATE_CHUNK_SIMILARITY)
+    for filename in profile["processed_texts"]:
+        digest = profile["pdfs"].get(filename)
+        if not digest:
+            continue
+        if not extracted_texts.exists(digest):
+            # The extraction cache can be cleared on its own, so the text is extracted again from the stored PDF
+            try:
+                with pdf_blobs.open(digest) as blob:
+                    extracted_texts.put(digest, extract_file(blob))
+            except Exception as e:
+                print(f"Error extracting {filename} again, it is left out of the index: {str(e)}")
+                continue
+        index.add_document(filename, extracted_texts.iter_pages(digest), digest)
+    return index
+
+def save_profile(profile_name, *fields):
+    # Marks the given fields (every field if none are given) for the store's next debounced write
+    for field in fields or PROFILE_FIELDS:
+        profile_store.set(profile_name, field, profiles[profile_name][field])
+
+# Past queries per profile, paged from SQLite instead of kept in memory
+history_store = HistoryStore(os.path.join(PROFILES_DIR, "history.db"))
+
+# Finished LLM answers per profile, cleared whenever the profile's PDFs change
+response_cache = ResponseCache(RESPONSE_CACHE_DIR, RESPONSE_CACHE_MEMORY_ENTRIES, RESPONSE_CACHE_DISK_BYTES)
+
+# Chunk embeddings per profile, memory-mapped from profiles/<name>/embeddings.npy on first use
+vector_indexes = {}
+
+def embed_texts(texts):
+    # Pluggable: replace with any local embedder that returns an (n, dim) float32 array
+    return ollama_embed(ollama_server, EMBED_MODEL, texts)
+
+def get_vector_index(profile_name):
+    with profiles_lock:
+        if profile_name not in vector_indexes:
+            vector_indexes[profile_name] = VectorIndex(os.path.join(PROFILES_DIR, profile_name))
+        return vector_indexes[profile_name]
+
+def collect_unused_pdfs():
+    # Called with profiles_lock held. PDFs an ingest is storing are kept until it records them.
+    referenced = set(digest for profile in profiles.values() for digest in profile["pdfs"].values()) | set(ingesting_pdfs)
+    removed = pdf_blobs.collect_garbage(referenced)
+    if removed:
+        print(f"Removed {removed} PDF(s) no longer used by any profile")
 
 def create_profile(profile_name):
-    global profiles, current_profile
-    if profile_name not in profiles:
-        profiles[profile_name] = create_default_profile()
-        processed_texts = profiles[profile_name]["processed_texts"] #Added line
-        save_profile(profile_name)
-    current_profile = profile_name
+    # The dropdown change that follows switches this session to the new profile
+    with profiles_lock:
+        if profile_name not in profiles:
+            profiles[profile_name] = create_default_profile()
+            save_profile(profile_name)
     return gr.update(choices=list(profiles.keys()), value=profile_name), gr.update(value=profile_name)
 
-def delete_profile(profile_name):
-    global profiles, current_profile
-    if profile_name in profiles:
-        del profiles[profile_name]
-        profile_path = os.path.join(PROFILES_DIR, profile_name)
-        if os.path.exists(profile_path):
-            shutil.rmtree(profile_path)
-        if current_profile == profile_name:
-            current_profile = None
-        return gr.update(choices=list(profiles.keys()), value=None), f"Profile {profile_name} deleted successfully."
-    return gr.update(), f"Profile {profile_name} not found."
-
-def switch_profile(profile_name):
-    global current_profile, processed_texts
-    if profile_name not in profiles:
-        print(f"Profile {profile_name} not found. Creating a new profile.")
-        profiles[profile_name] = create_default_profile()
-        save_profile(profile_name)
-    
-    current_profile = profile_name
-    processed_texts = profiles[profile_name].get("processed_texts", {})
+def delete_profile(profile_name, session_profile):
+    with profiles_lock:
+        if profile_name in profiles:
+            del profiles[profile_name]
+            profile_store.delete(profile_name)
+            vector_indexes.pop(profile_name, None)
+            response_cache.invalidate(profile_name)
+            history_store.delete_profile(profile_name)
+            profile_path = os.path.join(PROFILES_DIR, profile_name)
+            if os.path.exists(profile_path):
+                shutil.rmtree(profile_path)
+            collect_unused_pdfs()
+            if session_profile == profile_name:
+                session_profile = None
+            return gr.update(choices=list(profiles.keys()), value=None), f"Profile {profile_name} deleted successfully.", session_profile
+    return gr.update(), f"Profile {profile_name} not found.", session_profile
+
+def switch_profile(profile_name, request: gr.Request = None):
+    # Returns the profile's settings and, last, the name to keep in this session's profile state.
+    # A query still running for the previous profile is cancelled.
+    if request is not None:
+        cancel_query(request.session_hash)
+    if not profile_name:
+        return (*[gr.update() for _ in range(14 + len(priority_explanations))], None)
+    with profiles_lock:
+        if profile_name not in profiles:
+            print(f"Profile {profile_name} not found. Creating a new profile.")
+            profiles[profile_name] = create_default_profile()
+            save_profile(profile_name)
+    warm_up_models(profile_models(profiles[profile_name]))
     
     return (
         gr.update(value=profiles[profile_name].get("agents", ["General"])),
@@ -152,62 +299,155 @@ def switch_profile(profile_name):
         gr.update(value=profiles[profile_name].get("use_legal_situational_context", False)),
         gr.update(value=profiles[profile_name].get("use_entity_context", False)),
         gr.update(value=profiles[profile_name].get("use_general_crypto_knowledge", False)),
+        gr.update(value=profiles[profile_name].get("retrieval_mode", "Keyword")),
+        gr.update(value=profiles[profile_name].get("agent_call_mode", "Separate calls")),
+        gr.update(value=agent_model_rows(profiles[profile_name])),
         gr.update(value=f"Switched to profile: {profile_name}"),
         gr.update(value=list(profiles[profile_name].get("pdfs", {}).keys())),
-        *[gr.update(value="") for _ in range(len(priority_explanations))]  # Clear all output fields
+        *[gr.update(value="") for _ in range(len(priority_explanations))],  # Clear all output fields
+        profile_name
     )
 
-def process_pdfs(pdf_files):
-    global processed_texts, profiles, current_profile
+def process_pdfs(pdf_files, profile_name, keep_existing=False):
+    # Generator so Gradio can show per-file progress in the status box while extraction runs. The
+    # files replace the profile's PDFs unless keep_existing is set, in which case they are added.
     print(f"Current working directory: {os.getcwd()}")
-    print(f"Processing PDFs: {[pdf_file.name for pdf_file in pdf_files]}")
     if not pdf_files:
-        return "Please upload at least one PDF."
+        yield "Please upload at least one PDF."
+        return
+    print(f"Processing PDFs: {[pdf_file.name for pdf_file in pdf_files]}")
     
-    if current_profile is None:
-        return "Please select or create a profile before processing PDFs."
+    if profile_name not in profiles:
+        yield "Please select or create a profile before processing PDFs."
+        return
     
     try:
+        ingest_started = time.perf_counter()
+        profile = profiles[profile_name]
         # Check for removed PDFs
-        current_pdf_names = set(pdf.name for pdf in pdf_files)
-        removed_pdfs = set(profiles[current_profile]["pdfs"].keys()) - current_pdf_names
-        for removed_pdf in removed_pdfs:
-            del profiles[current_profile]["pdfs"][removed_pdf]
-            if removed_pdf in profiles[current_profile]["processed_texts"]:
-                del profiles[current_profile]["processed_texts"][removed_pdf]
+        current_pdf_names = set(os.path.basename(pdf.name) for pdf in pdf_files)
+        with profiles_lock:
+            removed_pdfs = set() if keep_existing else set(profile["pdfs"].keys()) - current_pdf_names
+            for removed_pdf in removed_pdfs:
+                del profile["pdfs"][removed_pdf]
+                profile["processed_texts"].pop(removed_pdf, None)
+                profile["index"].remove_document(removed_pdf)
         
-        profiles[current_profile]["processed_texts"].clear()  # Clear existing processed texts
+        # Only documents whose content changed need their text and index entries rebuilt. Text is
+        # streamed through extracted_texts page by page, so only digests are held here.
+        to_extract = {}  # path -> digest
+        to_label = {}  # path -> digest of a PDF whose text is already stored
+        copies = {}  # path -> digest of a PDF that is also being extracted under another name
+        cache_hits = 0
+        hashing_started = time.perf_counter()
         for pdf_file in pdf_files:
-            print(f"Attempting to process file: {pdf_file.name}")
             absolute_path = os.path.abspath(pdf_file.name)
             if not os.path.exists(absolute_path):
                 print(f"File not found: {absolute_path}")
-                return f"Error: File not found - {absolute_path}"
+                yield f"Error: File not found - {absolute_path}"
+                return
+            filename = os.path.basename(absolute_path)
+            digest = file_sha256(absolute_path)
+            if profile["pdfs"].get(filename) == digest and filename in profile["processed_texts"]:
+                cache_hits += 1
+                continue
+            if extracted_texts.exists(digest):
+                cache_hits += 1
+                to_label[absolute_path] = digest
+            elif digest in to_extract.values():
+                copies[absolute_path] = digest
+            else:
+                to_extract[absolute_path] = digest
+        stage_seconds.observe(time.perf_counter() - hashing_started, stage="ingest_hash")
+        if removed_pdfs or to_label or to_extract or copies:
+            response_cache.invalidate(profile_name)  # Cached answers may rely on the old documents
+        
+        last_saved = [time.monotonic()]
+        def save_progress(force=False):
+            # Documents indexed so far are saved every INGEST_CHECKPOINT_SECONDS, so an interrupted
+            # ingest only has to redo the rest
+            if force or time.monotonic() - last_saved[0] >= INGEST_CHECKPOINT_SECONDS:
+                with profiles_lock:
+                    save_profile(profile_name, "pdfs", "processed_texts", "index")
+                last_saved[0] = time.monotonic()
+        
+        replaced_pdfs = [False]
+        def add_document(absolute_path, digest):
+            filename = os.path.basename(absolute_path)
+            # The digest is pinned from before the blob is stored until the profile refers to it, so
+            # a garbage collection from another session can't remove the blob in between
+            with profiles_lock:
+                ingesting_pdfs[digest] += 1
             try:
-                reader = PdfReader(absolute_path)
-                text = ""
-                for page in reader.pages:
-                    text += page.extract_text() + " "
-                filename = os.path.basename(pdf_file.name)
-                labeled_text = f"[PDF: {filename}]\n{text.strip()}\n[End of {filename}]"
-                profiles[current_profile]["processed_texts"][filename] = labeled_text
-                
-                # Save PDF content to profile
-                with open(absolute_path, "rb") as f:
-                    profiles[current_profile]["pdfs"][filename] = f.read()
-            except Exception as e:
-                error_message = f"Error processing PDF {pdf_file.name}: {str(e)}\nError type: {type(e).__name__}\nFile path: {absolute_path}"
+                # Only new or changed files get here; a PDF already in the blob store is not copied again
+                blob_digest = pdf_blobs.put_file(absolute_path, digest)
+                with timed("ingest_index"):
+                    # The document is chunked and tokenised without the lock; only the merge into the
+                    # shared index holds it, so queries aren't kept waiting by a long PDF
+                    summary = document_summary(extracted_texts.iter_pages(digest))
+                    prepared = profile["index"].prepare_document(extracted_texts.iter_pages(digest), digest)
+                    with profiles_lock:
+                        profile["processed_texts"][filename] = summary
+                        profile["index"].add_prepared(filename, prepared)
+                        if profile["pdfs"].get(filename, blob_digest) != blob_digest:
+                            replaced_pdfs[0] = True  # The old content may now be unused
+                        profile["pdfs"][filename] = blob_digest
+            finally:
+                with profiles_lock:
+                    ingesting_pdfs[digest] -= 1
+                    if not ingesting_pdfs[digest]:
+                        del ingesting_pdfs[digest]
+            save_progress()
+        
+        for absolute_path, digest in to_label.items():
+            add_document(absolute_path, digest)
+        
+        if to_extract:
+            yield f"Extracting text from {len(to_extract)} PDF(s) ({cache_hits} unchanged or cached)..."
+        extract_started = time.perf_counter()
+        extracted = 0
+        for absolute_path, pages_done, page_count, error in extract_pdfs(to_extract):
+            filename = os.path.basename(absolute_path)
+            if error is not None:
+                error_message = f"Error processing PDF {filename}: {str(error)}\nError type: {type(error).__name__}\nFile path: {absolute_path}"
+                if pages_done:
+                    error_message += f"\n{pages_done} of {page_count} pages were saved; processing the PDFs again resumes from page {pages_done + 1}."
                 print(error_message)
-                return error_message
+                save_progress(force=True)
+                yield error_message
+                return
+            if pages_done < page_count:
+                yield f"Extracting {filename}: {pages_done}/{page_count} pages ({extracted}/{len(to_extract)} PDF(s) done)"
+                continue
+            extracted += 1
+            add_document(absolute_path, to_extract[absolute_path])
+            print(f"Extracted {filename} ({page_count} pages)")
+            yield f"Extracted {extracted}/{len(to_extract)}: {filename} ({page_count} pages)"
+        for absolute_path, digest in copies.items():
+            add_document(absolute_path, digest)
+        if to_extract:
+            stage_seconds.observe(time.perf_counter() - extract_started, stage="ingest_extract")
+        save_progress(force=True)
         
-        save_profile(current_profile)
+        if profile["retrieval_mode"] in SEMANTIC_RETRIEVAL_MODES and semantic_available():
+            yield "Computing chunk embeddings for semantic retrieval..."
+            try:
+                with timed("ingest_embed"):
+                    embedded = get_vector_index(profile_name).sync(profile["index"], embed_texts, EMBED_MODEL, profiles_lock)
+                print(f"Embedded {embedded} new chunk(s)")
+            except Exception as e:
+                print(f"Error computing embeddings, keyword retrieval will be used: {str(e)}")
+        if removed_pdfs or replaced_pdfs[0]:
+            with profiles_lock:
+                collect_unused_pdfs()
         
-        total_word_count = sum(len(text.split()) for text in profiles[current_profile]["processed_texts"].values())
-        success_message = f"Processed {len(profiles[current_profile]['processed_texts'])} unique PDF(s). Total word count: {total_word_count}. All text has been extracted, labeled, and will be used as context."
+        total_word_count = sum(summary["words"] for summary in profile["processed_texts"].values())
+        success_message = f"Processed {len(profile['processed_texts'])} unique PDF(s) ({cache_hits} from cache, {len(to_extract)} freshly extracted). Total word count: {total_word_count}. All text has been extracted, labeled, and will be used as context."
         print(success_message)
-        return success_message
+        stage_seconds.observe(time.perf_counter() - ingest_started, stage="ingest_total")
+        yield success_message
     except Exception as e:
-        return f"An error occurred while processing the PDFs: {str(e)}"
+        yield f"An error occurred while processing the PDFs: {str(e)}"
 
 priority_explanations = {
     "Maxed": "Combine all agents and provide a concise summary",
@@ -239,10 +479,9 @@ color_schemes = {
     "Political aspects": "#F0FFF0"  # Honeydew for political aspects
 }
 
-def ollama_chat(question, context, priority, decision_mode, custom_text, applicable_location, applicable_entity, use_legal_situational_context, use_entity_context, use_general_crypto_knowledge):
-    relevant_context = get_relevant_chunk(question, context)
-    priority_instruction = f"Only report on {priority.lower()} considerations ({priority_explanations[priority]}) in your decision-making process. Regardless of what is said later in this prompt, only tell me about {priority.lower()} considerations and no other. If there is no relevant information, or comments you can make with common knowledge relavant to the prompt, just state 'No useful info from PDFs in this answer.'" if priority != "General" else ""
-
+def build_shared_prompt(question, relevant_context, decision_mode, custom_text, applicable_location, applicable_entity, use_legal_situational_context, use_entity_context, use_general_crypto_knowledge):
+    # Everything here is identical for every agent answering the same query, so it forms a stable
+    # prompt prefix that Ollama can reuse from its KV cache instead of re-evaluating per agent
     mode_instruction = ""
     if decision_mode == "Pick out Data":
         mode_instruction = "Help surf these documents for relavant data to the user query."
@@ -255,7 +494,7 @@ def ollama_chat(question, context, priority, decision_mode, custom_text, applica
     entity_context = f"Use your own information relevant to the entity {applicable_entity} somewhere in your response - show off your knowledge and tie it in somewhere." if use_entity_context else ""
     general_crypto_knowledge = "Consider any applicable projects, information or decisions made from general crypto knowledge that you know about. If analysing a project/product, compare it to another similar product and talk about how successful it was and how it could be learned from." if use_general_crypto_knowledge else ""
 
-    formatted_prompt = f"""Your purpose is to be a crypto-specialised AI that helps either pick out data, summarize, or make decisions using data you're provided with and data you can reasonably infer from own knowledge. {priority_instruction}
+    return f"""Your purpose is to be a crypto-specialised AI that helps either pick out data, summarize, or make decisions using data you're provided with and data you can reasonably infer from own knowledge.
 
 Your operating mode: {mode_instruction}
 ##
@@ -264,35 +503,169 @@ Your operating mode: {mode_instruction}
 ##
 {general_crypto_knowledge}
 
-The context contains text from multiple PDFs, labeled with their filenames when they start and end using square brackets. Ignore all old context or information from pdfs not provided in this whole prompt, they CANNOT be used or mentioned. Use these square bracket labels to specify which PDF you're referring to in your answer. Every time you answer a question, specify whether there was any useful info from a PDF if answering from it. Wherever possible, use context from the PDFs to answer your question and quote relevant sentences. Give your answer within a maximum of 70 words and use bullet points, be concise. Sources and references to regulations, laws, policies etc. are allowed outside of the word limit and are greatly appreciated.
+The context contains text from multiple PDFs, labeled with their filenames and page numbers when they start and end using square brackets. Ignore all old context or information from pdfs not provided in this whole prompt, they CANNOT be used or mentioned. Use these square bracket labels to specify which PDF and page you're referring to in your answer. Every time you answer a question, specify whether there was any useful info from a PDF if answering from it. Wherever possible, use context from the PDFs to answer your question and quote relevant sentences. Give your answer within a maximum of 70 words and use bullet points, be concise. Sources and references to regulations, laws, policies etc. are allowed outside of the word limit and are greatly appreciated.
 
 {custom_text}
 
 User-provided context: {relevant_context}
 
-User Input: {question}
+User Input: {question}"""
+
+def build_agent_instruction(priority):
+    # The only per-agent part of the prompt, placed last so it doesn't break the shared prefix
+    priority_instruction = f"Only report on {priority.lower()} considerations ({priority_explanations[priority]}) in your decision-making process. Regardless of what is said earlier in this prompt, only tell me about {priority.lower()} considerations and no other. If there is no relevant information, or comments you can make with common knowledge relavant to the prompt, just state 'No useful info from PDFs in this answer.'" if priority != "General" else ""
+    return f"""{priority_instruction}
 
 Answer:"""
 
+def log_ollama_stats(label, kind, stats):
+    # Records the stats of the final streamed message in the metrics and prints them. A reused prompt
+    # prefix shows up as a much smaller prompt eval time for every agent after the first.
+    seconds = observe_ollama_stats(kind, stats)
+    prompt_eval_ms = seconds.get("prompt_eval", 0) * 1000
+    eval_ms = seconds.get("eval", 0) * 1000
+    print(f"[{label}] prompt eval: {stats.get('prompt_eval_count', 0)} tokens in {prompt_eval_ms:.0f} ms, generation: {stats.get('eval_count', 0)} tokens in {eval_ms:.0f} ms")
+
+def model_roles():
+    # Everything a profile can route to its own model; Maxed shares the MasterAgent synthesis
+    return [priority for priority in priority_explanations if priority != "Maxed"] + [NOTES_MODEL_ROLE]
+
+def clean_agent_models(pairs):
+    # (role, model) pairs, e.g. Models table rows, as the profile's agent_models: models are stripped
+    # and roles left blank are dropped so they fall back to the default tier
+    roles = model_roles()
+    return {str(role): str(model).strip() for role, model in pairs if role in roles and model and str(model).strip()}
+
+def agent_model(profile, role):
+    default = SYNTHESIS_MODEL if role in ("Maxed", "MasterAgent") else SPECIALIST_MODEL
+    return profile.get("agent_models", {}).get("MasterAgent" if role == "Maxed" else role) or default
+
+def profile_models(profile, roles=None):
+    return sorted(set(agent_model(profile, role) for role in (roles if roles is not None else model_roles())))
+
+def agent_model_rows(profile):
+    return [[role, agent_model(profile, role)] for role in model_roles()]
+
+# When each model was last asked to stay loaded, by a query or a warm-up
+model_last_used = {}
+model_last_used_lock = threading.Lock()
+
+def mark_model_used(model):
+    with model_last_used_lock:
+        model_last_used[model] = time.monotonic()
+
+def warm_up_models(models):
+    # Keep-alive policy: every request asks Ollama to keep its model loaded for OLLAMA_KEEP_ALIVE, and
+    # a routed model not used for half that time is loaded again in the background, so a profile
+    # switch, a model change or the start of a query brings it into memory before an agent needs it
+    now = time.monotonic()
+    with model_last_used_lock:
+        cold = [model for model in models if now - model_last_used.get(model, -OLLAMA_KEEP_ALIVE_SECONDS) > OLLAMA_KEEP_ALIVE_SECONDS / 2]
+        for model in cold:
+            model_last_used[model] = now
+    for model in cold:
+        threading.Thread(target=load_model, args=(model,), name="novadocs-warm-up", daemon=True).start()
+
+def load_model(model):
+    # A generate request without a prompt only loads the model
+    try:
+        with timed("model_warm_up"):
+            requests.post(f"{ollama_server}/api/generate", json={"model": model, "keep_alive": OLLAMA_KEEP_ALIVE}, timeout=600).raise_for_status()
+        print(f"Loaded model {model}")
+    except Exception as e:
+        print(f"Could not warm up model {model}: {str(e)}")
+        with model_last_used_lock:
+            model_last_used.pop(model, None)
+
+def ollama_stream(messages, label, model=SPECIALIST_MODEL, options=None, cache_tag=None, kind="agent", format=None):
+    # Streams a chat completion from Ollama, yielding the accumulated text and returning it at the end.
+    # With a cache_tag (the profile name) finished answers are cached and replayed without calling Ollama.
+    # kind (agent, synthesis, map or reduce) groups the call's timings in the metrics, and format is
+    # an optional JSON schema Ollama constrains the output to.
+    payload = {"model": model, "messages": messages, "options": options or {}}
+    if format is not None:
+        payload["format"] = format
+    key = cache_key(payload) if cache_tag is not None else None
+    if key is not None:
+        cached = response_cache.get(cache_tag, key)
+        if cached is not None:
+            print(f"[{label}] answered from response cache")
+            yield cached
+            return cached
+
+    started = time.perf_counter()
+    mark_model_used(model)
+    response = requests.post(f"{ollama_server}/api/chat", json=dict(payload, keep_alive=OLLAMA_KEEP_ALIVE), stream=True)
+    cancellation = getattr(stream_context, "cancellation", None)
+    if cancellation is not None:
+        cancellation.track(response)
     try:
-        response = requests.post(f"{ollama_server}/api/chat", json={
-            "model": "llama3.2",
-            "messages": [{'role': 'user', 'content': formatted_prompt}]
-        }, stream=True)
         response.raise_for_status()
-        
+
         full_response = ""
+        finished = False
         for line in response.iter_lines():
             if line:
                 json_response = json.loads(line)
                 if 'message' in json_response and 'content' in json_response['message']:
+                    if not full_response:
+                        stage_seconds.observe(time.perf_counter() - started, stage=f"{kind}_first_token")
                     full_response += json_response['message']['content']
-                    yield full_response  # Yield the accumulated response for Gradio to update in real-time
-        
-        final_answer = re.sub(r'<think>.*?</think>', '', full_response, flags=re.DOTALL).strip()
-        # Remove the first line if it starts with "Here" or "Here's"
-        final_answer = '\n'.join(line for line in final_answer.split('\n') if not line.strip().lower().startswith(("here", "here's")))
-        return final_answer
+                    yield full_response
+                if json_response.get("done"):
+                    finished = True
+                    log_ollama_stats(label, kind, json_response)
+    finally:
+        # Also runs when a cancelled stream is closed, which drops the connection and stops generation
+        if cancellation is not None:
+            cancellation.untrack(response)
+        response.close()
+    stage_seconds.observe(time.perf_counter() - started, stage=f"{kind}_call")
+    if key is not None and finished:  # A cut-off stream is never cached as the answer
+        response_cache.put(cache_tag, key, full_response)
+    return full_response
+
+def failed_answer(text):
+    # True for an error message, and for an answer that was cancelled before or while it streamed
+    return text.startswith(FAILED_ANSWER_PREFIXES) or text.endswith(f"[{CANCELLED_MESSAGE}]")
+
+def clean_answer(text):
+    final_answer = re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL).strip()
+    # Remove the first line if it starts with "Here" or "Here's"
+    return '\n'.join(line for line in final_answer.split('\n') if not line.strip().lower().startswith(("here", "here's")))
+
+def build_combined_instruction(priorities):
+    # Single JSON call mode: every selected agent's instruction in one request, answered as one JSON field each
+    lines = "\n".join(f'- "{priority}": only report on {priority.lower()} considerations ({priority_explanations[priority]})' if priority != "General" else '- "General": consider all aspects' for priority in priorities)
+    return f"""Answer separately for each of the following priorities, as a JSON object with one field per priority. Each field holds only that priority's answer, following the instructions above (bullet points, at most 70 words). If there is no relevant information for a priority, or comments you can make with common knowledge relavant to the prompt, its field just states 'No useful info from PDFs in this answer.'
+{lines}
+
+Answer:"""
+
+def agents_schema(priorities):
+    return {"type": "object", "properties": {priority: {"type": "string"} for priority in priorities}, "required": list(priorities)}
+
+def ollama_multi_agent_chat(question, relevant_context, priorities, decision_mode, custom_text, applicable_location, applicable_entity, use_legal_situational_context, use_entity_context, use_general_crypto_knowledge, profile_name=None, model=SPECIALIST_MODEL):
+    # One prompt evaluation for all selected agents: yields the JSON streamed so far and returns it complete
+    with timed("agent_prompt_build"):
+        shared_prompt = build_shared_prompt(question, relevant_context, decision_mode, custom_text, applicable_location, applicable_entity, use_legal_situational_context, use_entity_context, use_general_crypto_knowledge)
+        formatted_prompt = f"{shared_prompt}\n\n{build_combined_instruction(priorities)}"
+    try:
+        return (yield from ollama_stream([{'role': 'user', 'content': formatted_prompt}], f"Agents (single call, {model})", model=model, cache_tag=profile_name, format=agents_schema(priorities)))
+    except requests.RequestException as e:
+        return f"Error communicating with Ollama API: {str(e)}"
+    except Exception as e:
+        return f"An unexpected error occurred: {str(e)}"
+
+def ollama_chat(question, relevant_context, priority, decision_mode, custom_text, applicable_location, applicable_entity, use_legal_situational_context, use_entity_context, use_general_crypto_knowledge, profile_name=None, model=SPECIALIST_MODEL):
+    with timed("agent_prompt_build"):
+        shared_prompt = build_shared_prompt(question, relevant_context, decision_mode, custom_text, applicable_location, applicable_entity, use_legal_situational_context, use_entity_context, use_general_crypto_knowledge)
+        formatted_prompt = f"{shared_prompt}\n\n{build_agent_instruction(priority)}"
+
+    try:
+        # Yields the accumulated response for Gradio to update in real-time
+        full_response = yield from ollama_stream([{'role': 'user', 'content': formatted_prompt}], priority, model=model, cache_tag=profile_name)
+        return clean_answer(full_response)
     except requests.RequestException as e:
         return f"Error communicating with Ollama API: {str(e)}"
     except json.JSONDecodeError as e:
@@ -300,29 +673,292 @@ Answer:"""
     except Exception as e:
         return f"An unexpected error occurred: {str(e)}"
 
-def get_relevant_chunk(question, context, chunk_size=CHUNK_SIZE):
-    words = set(question.lower().split())
-    chunks = [context[i:i+chunk_size] for i in range(0, len(context), chunk_size)]
-    scores = [sum(1 for word in words if word in chunk.lower()) for chunk in chunks]
-    return chunks[scores.index(max(scores))]
+def rank_chunks(question, index, retrieval_mode="Keyword", vectors=None, top_k=RETRIEVAL_CANDIDATES):
+    # Ranked lookup against the profile's persistent indexes (built in process_pdfs): BM25 by
+    # default, cosine similarity over chunk embeddings, or a fusion of both in Hybrid mode. The
+    # shared index is read under profiles_lock; embedding calls to Ollama run outside it.
+    if retrieval_mode in SEMANTIC_RETRIEVAL_MODES and vectors is not None:
+        try:
+            vectors.sync(index, embed_texts, EMBED_MODEL, profiles_lock)  # No-op unless chunks changed since ingest
+            query_vector = embed_texts([question])[0]
+            lexical_weight = HYBRID_LEXICAL_WEIGHT if retrieval_mode == "Hybrid" else 0.0
+            with profiles_lock:
+                lexical_scores = index.score(question) if lexical_weight else None
+            ranked = vectors.search(query_vector, top_k, lexical_scores, lexical_weight)
+            if ranked:
+                return ranked
+        except Exception as e:
+            print(f"Semantic retrieval failed, falling back to keyword retrieval: {str(e)}")
+    with profiles_lock:
+        return index.search(question, top_k)
+
+def get_relevant_chunk(question, index, token_budget=CONTEXT_TOKEN_BUDGET, retrieval_mode="Keyword", vectors=None):
+    # Fills the token budget with the best non-overlapping chunks, each labelled with its PDF and pages
+    with timed(f"retrieval_rank_{retrieval_mode.lower()}"):
+        ranked = rank_chunks(question, index, retrieval_mode, vectors)
+    with timed("retrieval_pack"), profiles_lock:
+        return "\n\n".join(format_chunk(chunk) for chunk in pack_chunks(index, ranked, token_budget))
+
+# Shared by every query so the total number of in-flight Ollama streams never exceeds the limit
+agent_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_AGENTS, thread_name_prefix="novadocs-agent")
+
+# Per-thread state of the stream an agent pool thread is running; ollama_stream reads the cancellation from it
+stream_context = threading.local()
+
+class Cancellation:
+    # Cooperative cancellation of one query. Its streams stop at the next token once it is set, and
+    # any Ollama response they are blocked on has its socket shut down so the model slot is freed at once.
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.responses = set()
+
+    def is_set(self):
+        return self.event.is_set()
+
+    def cancel(self):
+        with self.lock:
+            self.event.set()
+            responses = list(self.responses)
+        for response in responses:
+            abort_response(response)
 
-def generate_MasterAgent_output(results, agents):
+    def track(self, response):
+        with self.lock:
+            self.responses.add(response)
+            cancelled = self.event.is_set()
+        if cancelled:
+            abort_response(response)
+
+    def untrack(self, response):
+        with self.lock:
+            self.responses.discard(response)
+
+def abort_response(response):
+    # Shuts the socket down under the reading thread so a blocked read returns at once; closing the
+    # response is left to that thread
+    sock = getattr(getattr(response.raw, "connection", None), "sock", None)
+    if sock is None:
+        # http.client hands the socket over to the response when the server will close the connection
+        sock = getattr(getattr(getattr(getattr(response.raw, "_fp", None), "fp", None), "raw", None), "_sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+# The query each browser session is running, so a newer query, a profile switch or Stop can cancel it
+active_queries = {}  # session hash -> Cancellation
+active_queries_lock = threading.Lock()
+
+def begin_query(session):
+    cancellation = Cancellation()
+    if session is None:
+        return cancellation
+    with active_queries_lock:
+        previous = active_queries.get(session)
+        active_queries[session] = cancellation
+    if previous is not None:
+        previous.cancel()
+    return cancellation
+
+def end_query(session, cancellation):
+    with active_queries_lock:
+        if active_queries.get(session) is cancellation:
+            del active_queries[session]
+
+def cancel_query(session):
+    with active_queries_lock:
+        cancellation = active_queries.pop(session, None)
+    if cancellation is not None:
+        cancellation.cancel()
+
+def stop_query(request: gr.Request = None):
+    if request is not None:
+        cancel_query(request.session_hash)
+
+def start_streams(jobs, cancellation=None):
+    # jobs maps a key to a callable returning a streaming generator. Each stream runs on the agent
+    # pool and reports (key, text, done) on the returned queue, ending with the stream's return value.
+    # Once the cancellation is set, streams are closed and end with their partial text marked cancelled.
+    updates = queue.Queue()
+
+    def run(key, make_stream):
+        text = None
+        streamed = None
+        stream_context.cancellation = cancellation
+        try:
+            if cancellation is None or not cancellation.is_set():
+                stream = make_stream()
+                while True:
+                    if cancellation is not None and cancellation.is_set():
+                        stream.close()
+                        break
+                    try:
+                        text = next(stream)
+                    except StopIteration as stop:
+                        if stop.value is not None:
+                            text = stop.value
+                        break
+                    streamed = text
+                    updates.put((key, text, False))
+        except Exception as e:
+            text = f"An unexpected error occurred: {str(e)}"
+        finally:
+            stream_context.cancellation = None
+        if cancellation is not None and cancellation.is_set():
+            text = f"{streamed}\n\n[{CANCELLED_MESSAGE}]" if streamed else CANCELLED_MESSAGE
+        updates.put((key, text, True))
+
+    for key, make_stream in jobs.items():
+        agent_executor.submit(run, key, make_stream)
+    return updates
+
+def stream_frames(jobs, frame_interval=UI_FRAME_INTERVAL, cancellation=None):
+    # Yields {key: latest text} for the streams whose output changed, coalescing token arrivals to
+    # at most one frame per frame_interval, and a final frame once every stream is done
+    updates = start_streams(jobs, cancellation)
+    remaining = len(jobs)
+    frame = {}
+    deadline = time.monotonic() + frame_interval
+    while remaining:
+        try:
+            key, text, done = updates.get(timeout=max(0, deadline - time.monotonic()))
+            if done:
+                remaining -= 1
+            if text is not None:
+                frame[key] = text
+        except queue.Empty:
+            pass
+        if time.monotonic() >= deadline:
+            if frame:
+                yield frame
+                frame = {}
+            deadline = time.monotonic() + frame_interval
+    if frame:
+        yield frame
+
+def build_synthesis_prompt(results, agents):
     combined_output = " ".join([f"{priority}: {result}" for priority, result in zip(agents, results) if result != "Not selected"])
-    prompt = f"Summarize the following outputs in 200 words or less, removing any repetition and stating which priority contributed to each part: {combined_output}. Use bullet points, be concise and reference sources wherever possible. Don't give me an introduction and get straight to the content. Sources and references to regulations, laws, policies etc. are allowed outside of the word limit and are greatly appreciated."
+    return f"Summarize the following outputs in 200 words or less, removing any repetition and stating which priority contributed to each part: {combined_output}. Use bullet points, be concise and reference sources wherever possible. Don't give me an introduction and get straight to the content. Sources and references to regulations, laws, policies etc. are allowed outside of the word limit and are greatly appreciated."
+
+def document_sections(index, section_tokens=MAP_SECTION_TOKENS):
+    # Each document cut at chunk boundaries into sections of about section_tokens, in page order. A
+    # section is read from the text store as one byte range, from its first chunk's offset to its last
+    # chunk's end, so the sentences consecutive chunks overlap on are only read once. A passage repeated
+    # across the PDFs is only read where it was first indexed, so sections also end before a chunk
+    # collapsed into another. The chunk layout is copied under profiles_lock and the text read after.
+    with profiles_lock:
+        documents = [(name, [dict(index.chunks[chunk_id]) for chunk_id in chunk_ids]) for name, chunk_ids in index.doc_chunks.items()]
+    sections = []
+    for name, chunks in documents:
+        section = None
+        read_to = None  # End of the previous section when the next one carries straight on from it
+        for chunk in chunks:
+            end = chunk["offset"] + chunk["size"]
+            # About four bytes per token, as estimate_tokens counts
+            if section is not None and ("duplicate_of" in chunk or (end - section["offset"] + 3) // 4 > section_tokens):
+                sections.append(section)
+                read_to = None if "duplicate_of" in chunk else section["end"]
+                section = None
+            if "duplicate_of" in chunk:
+                continue
+            if section is None:
+                start = max(chunk["offset"], read_to + 1) if read_to is not None else chunk["offset"]
+                section = {"doc": name, "page": chunk["page"], "digest": chunk.get("digest"), "offset": start, "end": start, "text": ""}
+            if section["digest"] is None:
+                # Without a text store the chunk's own text is used. It matches its byte range with page
+                # breaks as spaces, so the part the previous chunk already covered is skipped.
+                text = index.read_chunk(chunk)
+                covered = section["end"] - chunk["offset"]
+                section["text"] += text.encode("utf-8")[covered:].decode("utf-8", errors="ignore") if covered > 0 else (" " if section["text"] else "") + text
+            section["end_page"] = chunk["end_page"]
+            section["end"] = max(section["end"], end)
+        if section is not None:
+            sections.append(section)
+    for section in sections:
+        digest, offset, end = section.pop("digest"), section.pop("offset"), section.pop("end")
+        if digest is not None:
+            section["text"] = index.text_store.read(digest, offset, end - offset)
+    return sections
+
+def take_notes(section, model=SPECIALIST_MODEL):
+    # "Map" step: bullet-point notes on one section, labelled with its PDF and pages like a retrieved chunk
+    label = format_chunk(dict(section, text="")).split("\n")[0]
+    prompt = f"Take notes on the following excerpt from a PDF for later analysis. List the key facts, figures, claims, risks, obligations and crypto-relevant details as short bullet points. Don't add anything that isn't in the excerpt and don't give an introduction.\n\n{section['text']}"
+    try:
+        notes = yield from ollama_stream([{'role': 'user', 'content': prompt}], f"Map {section['doc']}", model=model, cache_tag=MAP_REDUCE_CACHE_TAG, kind="map")
+        return f"{label}\n{notes.strip()}"
+    except Exception as e:
+        print(f"Error taking notes on {label}: {str(e)}")
+        return ""
+
+def merge_notes(notes, max_words, model=SPECIALIST_MODEL):
+    # "Reduce" step: merges several sets of notes, keeping the square bracket source labels
+    prompt = f"Merge the following notes on one or more PDFs into a single list of bullet points of at most {max_words} words. Remove repetition but keep every distinct fact, figure and risk, and keep the square bracket PDF and page labels next to the points they belong to. Don't give an introduction.\n\n" + "\n\n".join(notes)
+    try:
+        merged = yield from ollama_stream([{'role': 'user', 'content': prompt}], "Reduce", model=model, cache_tag=MAP_REDUCE_CACHE_TAG, kind="reduce")
+        return merged.strip()
+    except Exception as e:
+        print(f"Error merging notes: {str(e)}")
+        return "\n\n".join(notes)
+
+def collect_streams(jobs, cancellation=None):
+    # Runs the streams on the agent pool without showing partial output: yields the number of
+    # finished streams as each one ends and returns {key: final text}
+    updates = start_streams(jobs, cancellation)
+    results = {}
+    while len(results) < len(jobs):
+        key, text, done = updates.get()
+        if done:
+            results[key] = text or ""
+            yield len(results)
+    return results
+
+def map_reduce_document(sections, token_budget=CONTEXT_TOKEN_BUDGET, cancellation=None, model=SPECIALIST_MODEL):
+    # Whole document mode: every section gets a parallel "map" call on the agent pool, then the notes
+    # are merged level by level until they fit the context budget. Neither step depends on the question,
+    # so cached notes are reused by every later question over the same PDFs. Yields progress messages
+    # and returns the merged notes (None if cancelled).
+    jobs = {i: partial(take_notes, section, model) for i, section in enumerate(sections)}
+    reading = collect_streams(jobs, cancellation)
+    try:
+        while True:
+            yield f"Reading the whole document: {next(reading)}/{len(jobs)} sections..."
+    except StopIteration as stop:
+        mapped = stop.value
+    if cancellation is not None and cancellation.is_set():
+        return None
+    notes = [mapped[i] for i in sorted(mapped) if mapped[i]]
     
+    level = 1
+    while len(notes) > 1 and sum(estimate_tokens(note) for note in notes) > token_budget:
+        # Every group takes at least two sets of notes, so each level at least halves the count
+        groups = [[]]
+        for note in notes:
+            if len(groups[-1]) >= 2 and sum(estimate_tokens(other) for other in groups[-1] + [note]) > REDUCE_INPUT_TOKENS:
+                groups.append([])
+            groups[-1].append(note)
+        max_words = max(50, token_budget * 3 // 4 // len(groups))  # About 0.75 words per token
+        jobs = {i: partial(merge_notes, group, max_words, model) for i, group in enumerate(groups)}
+        merging = collect_streams(jobs, cancellation)
+        try:
+            while True:
+                yield f"Merging notes (level {level}): {next(merging)}/{len(jobs)}..."
+        except StopIteration as stop:
+            merged = stop.value
+        if cancellation is not None and cancellation.is_set():
+            return None
+        notes = [merged[i] for i in sorted(merged) if merged[i]]
+        level += 1
+    return "\n\n".join(notes)
+
+def generate_MasterAgent_output(results, agents, profile_name=None, model=SYNTHESIS_MODEL):
+    # Streams the synthesis like ollama_chat does, returning the cleaned-up summary at the end
+    with timed("synthesis_prompt_build"):
+        prompt = build_synthesis_prompt(results, agents)
     try:
-        response = requests.post(f"{ollama_server}/api/chat", json={
-            "model": "llama3.2",
-            "messages": [{'role': 'user', 'content': prompt}]
-        }, stream=True)
-        response.raise_for_status()
-        
-        full_response = ""
-        for line in response.iter_lines():
-            if line:
-                json_response = json.loads(line)
-                if 'message' in json_response and 'content' in json_response['message']:
-                    full_response += json_response['message']['content']
+        full_response = yield from ollama_stream([{'role': 'user', 'content': prompt}], "MasterAgent", model=model, cache_tag=profile_name, kind="synthesis")
         
         # Remove the first line if it starts with "Here" or "Here's"
         full_response = '\n'.join(line for line in full_response.split('\n') if not line.strip().lower().startswith(("here", "here's")))
@@ -330,43 +966,153 @@ def generate_MasterAgent_output(results, agents):
     except Exception as e:
         return f"Error generating MasterAgent output: {str(e)}"
 
-def ask_question(question, agents, decision_mode, custom_text, applicable_location, applicable_entity, use_legal_situational_context, use_entity_context, use_general_crypto_knowledge):
-    global processed_texts, history, profiles, current_profile
-    if not profiles[current_profile]["processed_texts"]:
-        return ["Please process PDFs first before asking questions."] * len(priority_explanations)
+def ask_question(question, agents, decision_mode, custom_text, applicable_location, applicable_entity, use_legal_situational_context, use_entity_context, use_general_crypto_knowledge, profile_name, request: gr.Request = None, save_settings=True, retrieval_mode=None, agent_call_mode=None):
+    # The settings used are saved to the profile, as the UI's last query, unless save_settings is off
+    # (headless callers). retrieval_mode and agent_call_mode override the profile's for this query only.
+    if profile_name not in profiles or not profiles[profile_name]["processed_texts"]:
+        yield ["Please process PDFs first before asking questions."] * len(priority_explanations)
+        return
+    # A newer query from the same session (or a profile switch, or Stop) cancels this one
+    session = request.session_hash if request is not None else None
+    cancellation = begin_query(session)
     try:
-        combined_context = "\n\n".join(profiles[current_profile]["processed_texts"].values())
+        # Context is gathered once for all agents
+        query_started = time.perf_counter()
+        profile = profiles[profile_name]
+        retrieval_mode = retrieval_mode or profile["retrieval_mode"]
+        agent_call_mode = agent_call_mode or profile["agent_call_mode"]
+        # Routed models that aren't loaded start loading now, while the context is gathered
+        roles = [priority for priority in priority_explanations if priority in agents or "Maxed" in agents]
+        if retrieval_mode == "Whole document":
+            roles.append(NOTES_MODEL_ROLE)
+        warm_up_models(profile_models(profile, roles))
+        if retrieval_mode == "Whole document":
+            sections = document_sections(profile["index"])
+            with profiles_lock:
+                pdfs_used = list(profile["processed_texts"].keys())
+            reading = map_reduce_document(sections, cancellation=cancellation, model=agent_model(profile, NOTES_MODEL_ROLE))
+            try:
+                while True:
+                    yield [next(reading)] * len(priority_explanations)
+            except StopIteration as stop:
+                relevant_context = stop.value
+            if cancellation.is_set():
+                yield [CANCELLED_MESSAGE] * len(priority_explanations)
+                return
+        else:
+            vectors = get_vector_index(profile_name) if retrieval_mode in SEMANTIC_RETRIEVAL_MODES and semantic_available() else None
+            relevant_context = get_relevant_chunk(question, profile["index"], retrieval_mode=retrieval_mode, vectors=vectors)
+            with profiles_lock:
+                pdfs_used = list(profile["processed_texts"].keys())
+        stage_seconds.observe(time.perf_counter() - query_started, stage="query_context")
         results = ["Generating..."] * len(priority_explanations)
         priority_list = list(priority_explanations.keys())
         
-        # Generate outputs for all agents except MasterAgent and Maxed
-        for i, priority in enumerate(priority_list[2:], 2):  # Skip "Maxed" and "MasterAgent" in this loop
-            if priority in agents or "Maxed" in agents:
-                for partial_result in ollama_chat(question, combined_context, priority, decision_mode, custom_text, applicable_location, applicable_entity, use_legal_situational_context, use_entity_context, use_general_crypto_knowledge):
-                    results[i] = partial_result
-                    yield results
-            else:
-                results[i] = "Not selected"
-                yield results
+        # Only boxes whose text changed since the last frame are sent; the rest get an empty update
+        changed = set(range(len(results)))
+        def frame():
+            update = [results[i] if i in changed else gr.update() for i in range(len(results))]
+            changed.clear()
+            return update
+        
+        def cancelled_frame():
+            # Boxes the superseded query never got to say so; streamed ones already carry the marker
+            for i, value in enumerate(results):
+                if value == "Generating...":
+                    results[i] = CANCELLED_MESSAGE
+                    changed.add(i)
+            return frame()
         
-        # Generate MasterAgent output if selected
+        # Work out which agents the MasterAgent (box 1) and Maxed (box 0) summaries cover; a box not
+        # selected says so before the agents start, so a cancelled query doesn't mark it cancelled
+        synthesis_agents = {}
         if "MasterAgent" in agents or "Maxed" in agents:
-            selected_agents = agents if "MasterAgent" in agents else priority_list[2:]
-            MasterAgent_results = [r for i, r in enumerate(results[2:]) if priority_list[i+2] in selected_agents]
-            results[1] = generate_MasterAgent_output(MasterAgent_results, selected_agents)
+            synthesis_agents[1] = [priority for priority in priority_list[2:] if priority in agents] if "MasterAgent" in agents else priority_list[2:]
         else:
             results[1] = "Not selected"
-        
-        # Generate Maxed output if selected
         if "Maxed" in agents:
-            results[0] = generate_MasterAgent_output(results[2:], priority_list[2:])
+            synthesis_agents[0] = priority_list[2:]
         else:
             results[0] = "Not selected"
         
-        yield results
+        # Generate outputs for all agents except MasterAgent and Maxed, streaming them in parallel
+        jobs = {}
+        for i, priority in enumerate(priority_list[2:], 2):  # Skip "Maxed" and "MasterAgent" in this loop
+            if priority in agents or "Maxed" in agents:
+                jobs[i] = partial(ollama_chat, question, relevant_context, priority, decision_mode, custom_text, applicable_location, applicable_entity, use_legal_situational_context, use_entity_context, use_general_crypto_knowledge, profile_name, agent_model(profile, priority))
+            else:
+                results[i] = "Not selected"
+        # In single JSON call mode the agents routed to the same model share one request whose fields
+        # are split into their boxes
+        combined = {}  # model -> {priority: box}
+        if agent_call_mode == "Single JSON call" and len(jobs) > 1:
+            for i in jobs:
+                combined.setdefault(agent_model(profile, priority_list[i]), {})[priority_list[i]] = i
+            jobs = {("combined", model): partial(ollama_multi_agent_chat, question, relevant_context, list(group), decision_mode, custom_text, applicable_location, applicable_entity, use_legal_situational_context, use_entity_context, use_general_crypto_knowledge, profile_name, model) for model, group in combined.items()}
+        yield frame()
+        
+        agents_started = time.perf_counter()
+        combined_texts = {}  # model -> JSON streamed so far
+        for updates in stream_frames(jobs, cancellation=cancellation):
+            for i, partial_result in updates.items():
+                if isinstance(i, tuple):
+                    group = combined[i[1]]
+                    combined_texts[i[1]] = partial_result
+                    for priority, value in partial_json_fields(partial_result).items():
+                        if priority in group and results[group[priority]] != value:
+                            results[group[priority]] = value
+                            changed.add(group[priority])
+                else:
+                    results[i] = partial_result
+                    changed.add(i)
+            yield frame()
+        if cancellation.is_set():
+            for i in (i for group in combined.values() for i in group.values()):
+                if results[i] != "Generating..." and not results[i].endswith(f"[{CANCELLED_MESSAGE}]"):
+                    results[i] = f"{results[i]}\n\n[{CANCELLED_MESSAGE}]"
+                    changed.add(i)
+            yield cancelled_frame()
+            return
+        for model, group in combined.items():
+            combined_text = combined_texts.get(model, "")
+            fields = partial_json_fields(combined_text)
+            for priority, i in group.items():
+                # Without any JSON (e.g. an error message) the raw reply is shown in every box
+                results[i] = clean_answer(fields[priority]) if priority in fields else "No answer returned for this agent." if fields else combined_text
+                changed.add(i)
+        if jobs:
+            stage_seconds.observe(time.perf_counter() - agents_started, stage="query_agents")
+        
+        # Identical synthesis requests (e.g. Maxed, which selects every agent) run once and stream into every box that asked for them
+        jobs = {}
+        boxes = {}
+        for box, selected_agents in synthesis_agents.items():
+            selected_results = [results[priority_list.index(priority)] for priority in selected_agents]
+            synthesis_prompt = build_synthesis_prompt(selected_results, selected_agents)
+            if synthesis_prompt not in jobs:
+                jobs[synthesis_prompt] = partial(generate_MasterAgent_output, selected_results, selected_agents, profile_name, agent_model(profile, "MasterAgent"))
+                boxes[synthesis_prompt] = []
+            boxes[synthesis_prompt].append(box)
+        
+        synthesis_started = time.perf_counter()
+        for updates in stream_frames(jobs, cancellation=cancellation):
+            for synthesis_prompt, partial_result in updates.items():
+                for box in boxes[synthesis_prompt]:
+                    results[box] = partial_result
+                    changed.add(box)
+            yield frame()
+        if jobs:
+            stage_seconds.observe(time.perf_counter() - synthesis_started, stage="query_synthesis")
+        if cancellation.is_set():
+            yield cancelled_frame()
+            return
+        
+        if changed:
+            yield frame()
+        stage_seconds.observe(time.perf_counter() - query_started, stage="query_total")
         
         # Save the history and update profile
-        history.append({
+        history_store.add(profile_name, {
             "question": question,
             "agents": agents,
             "decision_mode": decision_mode,
@@ -377,31 +1123,34 @@ def ask_question(question, agents, decision_mode, custom_text, applicable_locati
             "use_entity_context": use_entity_context,
             "use_general_crypto_knowledge": use_general_crypto_knowledge,
             "results": results[0],  # Only save Maxed interpretation
-            "pdfs_used": list(profiles[current_profile]["processed_texts"].keys()),
+            "pdfs_used": pdfs_used,
             "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         })
-        profiles[current_profile].update({
-            "agents": agents,
-            "decision_mode": decision_mode,
-            "custom_text": custom_text,
-            "last_question": question,
-            "applicable_location": applicable_location,
-            "applicable_entity": applicable_entity,
-            "use_legal_situational_context": use_legal_situational_context,
-            "use_entity_context": use_entity_context,
-            "use_general_crypto_knowledge": use_general_crypto_knowledge
-        })
-        save_profile(current_profile)
+        if save_settings:
+            with profiles_lock:
+                profile.update({
+                    "agents": agents,
+                    "decision_mode": decision_mode,
+                    "custom_text": custom_text,
+                    "last_question": question,
+                    "applicable_location": applicable_location,
+                    "applicable_entity": applicable_entity,
+                    "use_legal_situational_context": use_legal_situational_context,
+                    "use_entity_context": use_entity_context,
+                    "use_general_crypto_knowledge": use_general_crypto_knowledge
+                })
+                save_profile(profile_name, "agents", "decision_mode", "custom_text", "last_question", "applicable_location", "applicable_entity", "use_legal_situational_context", "use_entity_context", "use_general_crypto_knowledge")
     except Exception as e:
         error_message = f"An error occurred while processing your question: {str(e)}"
         yield [error_message] * len(priority_explanations)
+    finally:
+        cancellation.cancel()  # Stops anything still streaming if Gradio closed this generator early
+        end_query(session, cancellation)
 
-def display_history():
-    history_blocks = []
-    for i, entry in enumerate(reversed(history), 1):
-        block = f"""
+def render_history_entry(entry):
+    return f"""
         <div style="border: 1px solid #ddd; padding: 10px; margin-bottom: 10px; background-color: #100c0c;">
-            <h3 style="margin-top: 0;">Query {len(history) - i + 1}</h3>
+            <h3 style="margin-top: 0;">Query {entry['id']}</h3>
             <p><strong>Timestamp:</strong> {entry['timestamp']}</p>
             <p><strong>Question:</strong> {entry['question']}</p>
             <p><strong>agents:</strong> {', '.join(entry['agents'])}</p>
@@ -419,64 +1168,127 @@ def display_history():
             <p><strong>PDFs used:</strong> {', '.join(entry['pdfs_used'])}</p>
         </div>
         """
-        history_blocks.append(block)
-    return "".join(history_blocks)
+
+def load_history_page(profile_name, before_id, date_from, date_to, agent, pdf):
+    # Returns the rendered page and the cursor for the next one (None when there are no more entries)
+    entries = history_store.page(profile_name, HISTORY_PAGE_SIZE, before_id, date_from.strip() or None, date_to.strip() or None, agent or None, pdf.strip() or None)
+    cursor = entries[-1]["id"] if len(entries) == HISTORY_PAGE_SIZE else None
+    return "".join(render_history_entry(entry) for entry in entries), cursor
+
+def display_history(profile_name, date_from, date_to, agent, pdf):
+    history_html, cursor = load_history_page(profile_name, None, date_from, date_to, agent, pdf)
+    return history_html, cursor, gr.update(visible=cursor is not None)
+
+def load_more_history(profile_name, history_html, cursor, date_from, date_to, agent, pdf):
+    if cursor is None:
+        return history_html, None, gr.update(visible=False)
+    page_html, cursor = load_history_page(profile_name, cursor, date_from, date_to, agent, pdf)
+    return history_html + page_html, cursor, gr.update(visible=cursor is not None)
+
+def diagnostics_rows():
+    # One row per timing series for the Diagnostics tab; Ollama-reported token counts are not seconds
+    rows = []
+    for histogram in HISTOGRAMS:
+        for labels, count, mean, p50, p95 in histogram.summary():
+            name = " / ".join(labels.values())
+            unit = "tokens" if histogram.name.endswith("_tokens") else "s"
+            rows.append([histogram.name, name, unit, count] + [round(value, 4) if value is not None else None for value in (mean, p50, p95)])
+    return rows
 
 def reload_profiles():
-    global profiles
     load_profiles()
     return gr.update(choices=list(profiles.keys()))
 
 def initialize_app():
-    global profiles, current_profile
-    load_profiles()
-    if not profiles:
-        profiles["Default"] = create_default_profile()
-        save_profile("Default")
-    current_profile = list(profiles.keys())[0]
-    return gr.update(choices=list(profiles.keys()), value=current_profile)
+    # Runs once per browser session; profiles are already loaded and shared, so only the
+    # session's own selection is set up here
+    with profiles_lock:
+        if not profiles:
+            profiles["Default"] = create_default_profile()
+            save_profile("Default")
+        profile_name = list(profiles.keys())[0]
+    return gr.update(choices=list(profiles.keys()), value=profile_name), profile_name
 
 # Load existing profiles
 load_profiles()
 
-def save_agents(agents):
-    profiles[current_profile]["agents"] = agents
-    save_profile(current_profile)
+def save_agents(agents, profile_name):
+    with profiles_lock:
+        if profile_name in profiles:
+            profiles[profile_name]["agents"] = agents
+            save_profile(profile_name, "agents")
+    return gr.update()
+
+def save_decision_mode(decision_mode, profile_name):
+    with profiles_lock:
+        if profile_name in profiles:
+            profiles[profile_name]["decision_mode"] = decision_mode
+            save_profile(profile_name, "decision_mode")
     return gr.update()
 
-def save_decision_mode(decision_mode):
-    profiles[current_profile]["decision_mode"] = decision_mode
-    save_profile(current_profile)
+def save_custom_text(custom_text, profile_name):
+    with profiles_lock:
+        if profile_name in profiles:
+            profiles[profile_name]["custom_text"] = custom_text
+            save_profile(profile_name, "custom_text")
     return gr.update()
 
-def save_custom_text(custom_text):
-    profiles[current_profile]["custom_text"] = custom_text
-    save_profile(current_profile)
+def save_applicable_location(applicable_location, profile_name):
+    with profiles_lock:
+        if profile_name in profiles:
+            profiles[profile_name]["applicable_location"] = applicable_location
+            save_profile(profile_name, "applicable_location")
     return gr.update()
 
-def save_applicable_location(applicable_location):
-    profiles[current_profile]["applicable_location"] = applicable_location
-    save_profile(current_profile)
+def save_applicable_entity(applicable_entity, profile_name):
+    with profiles_lock:
+        if profile_name in profiles:
+            profiles[profile_name]["applicable_entity"] = applicable_entity
+            save_profile(profile_name, "applicable_entity")
     return gr.update()
 
-def save_applicable_entity(applicable_entity):
-    profiles[current_profile]["applicable_entity"] = applicable_entity
-    save_profile(current_profile)
+def save_use_legal_situational_context(use_legal_situational_context, profile_name):
+    with profiles_lock:
+        if profile_name in profiles:
+            profiles[profile_name]["use_legal_situational_context"] = use_legal_situational_context
+            save_profile(profile_name, "use_legal_situational_context")
     return gr.update()
 
-def save_use_legal_situational_context(use_legal_situational_context):
-    profiles[current_profile]["use_legal_situational_context"] = use_legal_situational_context
-    save_profile(current_profile)
+def save_use_entity_context(use_entity_context, profile_name):
+    with profiles_lock:
+        if profile_name in profiles:
+            profiles[profile_name]["use_entity_context"] = use_entity_context
+            save_profile(profile_name, "use_entity_context")
     return gr.update()
 
-def save_use_entity_context(use_entity_context):
-    profiles[current_profile]["use_entity_context"] = use_entity_context
-    save_profile(current_profile)
+def save_use_general_crypto_knowledge(use_general_crypto_knowledge, profile_name):
+    with profiles_lock:
+        if profile_name in profiles:
+            profiles[profile_name]["use_general_crypto_knowledge"] = use_general_crypto_knowledge
+            save_profile(profile_name, "use_general_crypto_knowledge")
     return gr.update()
 
-def save_use_general_crypto_knowledge(use_general_crypto_knowledge):
-    profiles[current_profile]["use_general_crypto_knowledge"] = use_general_crypto_knowledge
-    save_profile(current_profile)
+def save_retrieval_mode(retrieval_mode, profile_name):
+    with profiles_lock:
+        if profile_name in profiles:
+            profiles[profile_name]["retrieval_mode"] = retrieval_mode
+            save_profile(profile_name, "retrieval_mode")
+    return gr.update()
+
+def save_agent_call_mode(agent_call_mode, profile_name):
+    with profiles_lock:
+        if profile_name in profiles:
+            profiles[profile_name]["agent_call_mode"] = agent_call_mode
+            save_profile(profile_name, "agent_call_mode")
+    return gr.update()
+
+def save_agent_models(rows, profile_name):
+    # Rows of [agent, model] from the Models table; a blank model falls back to the default tier
+    with profiles_lock:
+        if profile_name in profiles:
+            profiles[profile_name]["agent_models"] = clean_agent_models(rows or [])
+            save_profile(profile_name, "agent_models")
+            warm_up_models(profile_models(profiles[profile_name]))
     return gr.update()
 
 
@@ -505,6 +1317,7 @@ with gr.Blocks(css="""
                     create_profile_btn = gr.Button("Create New Profile")
                     delete_profile_btn = gr.Button("Delete Profile")
                     reload_profiles_btn = gr.Button("Reload Profiles")
+                    profile_state = gr.State(None)  # This session's profile; other sessions keep their own
                 with gr.TabItem("Main"):
                     with gr.Row():
                         with gr.Column(scale=1):
@@ -521,6 +1334,24 @@ with gr.Blocks(css="""
                                 label="Operating Mode",
                                 value="Make Decision"
                             )
+                            retrieval_mode = gr.Radio(
+                                RETRIEVAL_MODES,
+                                label="Retrieval",
+                                value="Keyword"
+                            )
+                            agent_call_mode = gr.Radio(
+                                AGENT_CALL_MODES,
+                                label="Agent Calls",
+                                value="Separate calls"
+                            )
+                            with gr.Accordion("Models", open=False):
+                                agent_models = gr.Dataframe(
+                                    headers=["Agent", "Model"],
+                                    datatype=["str", "str"],
+                                    col_count=(2, "fixed"),
+                                    type="array",
+                                    label="Ollama model per agent (Maxed uses the MasterAgent model)"
+                                )
                             use_general_crypto_knowledge = gr.Checkbox(label="General Crypto Knowledge")
                             with gr.Row():
                                 use_legal_situational_context = gr.Checkbox(label="Enable Legal Situational Context")
@@ -530,7 +1361,9 @@ with gr.Blocks(css="""
                                 applicable_entity = gr.Textbox(label="Applicable Entity")
                             custom_text = gr.Textbox(label="Custom Prompt Injection", placeholder="Enter any additional instructions/context for the AI...")
                             question_input = gr.Textbox(label="Query:")
-                            submit_button = gr.Button("Submit Query")
+                            with gr.Row():
+                                submit_button = gr.Button("Submit Query")
+                                stop_button = gr.Button("Stop")
 
                         with gr.Column(scale=1):
                             status_output = gr.Textbox(label="Status/Output")
@@ -546,8 +1379,20 @@ with gr.Blocks(css="""
                                 )
 
                 with gr.TabItem("History"):
-                    history_output = gr.HTML(label="Query History")
+                    with gr.Row():
+                        history_date_from = gr.Textbox(label="From (YYYY-MM-DD)")
+                        history_date_to = gr.Textbox(label="To (YYYY-MM-DD)")
+                        history_agent = gr.Dropdown([""] + list(priority_explanations.keys()), label="Agent", value="")
+                        history_pdf = gr.Textbox(label="PDF")
                     refresh_history_button = gr.Button("Refresh History")
+                    history_output = gr.HTML(label="Query History")
+                    history_cursor = gr.State(None)
+                    load_more_history_button = gr.Button("Load More", visible=False)
+
+                with gr.TabItem("Diagnostics"):
+                    gr.Markdown(f"Per-stage timings since start-up. Prometheus can scrape the same histograms from /metrics on port {METRICS_PORT}." if METRICS_PORT else "Per-stage timings since start-up.")
+                    refresh_diagnostics_button = gr.Button("Refresh Diagnostics")
+                    diagnostics_output = gr.Dataframe(headers=["Metric", "Series", "Unit", "Count", "Mean", "p50", "p95"], interactive=False)
 
     # Add custom CSS for each priority's background color
     for priority, color in color_schemes.items():
@@ -562,24 +1407,28 @@ with gr.Blocks(css="""
 
     agents.change(fn=update_visibility, inputs=[agents], outputs=output_texts)
 
-    process_button.click(fn=process_pdfs, inputs=[pdf_files], outputs=[status_output])
+    process_button.click(fn=process_pdfs, inputs=[pdf_files, profile_state], outputs=[status_output])
 
-    def check_processed_pdfs(question, agents, decision_mode, custom_text, applicable_location, applicable_entity, use_legal_situational_context, use_entity_context, use_general_crypto_knowledge):
-        if not profiles[current_profile]["processed_texts"]:
+    def check_processed_pdfs(question, agents, decision_mode, custom_text, applicable_location, applicable_entity, use_legal_situational_context, use_entity_context, use_general_crypto_knowledge, profile_name):
+        if profile_name not in profiles or not profiles[profile_name]["processed_texts"]:
             return [gr.update(value="Please process PDFs first before asking questions.")] + [gr.update()] * len(priority_explanations)
         return [gr.update()] * (len(priority_explanations) + 1)
 
     submit_button.click(
         fn=check_processed_pdfs,
-        inputs=[question_input, agents, decision_mode, custom_text, applicable_location, applicable_entity, use_legal_situational_context, use_entity_context, use_general_crypto_knowledge],
+        inputs=[question_input, agents, decision_mode, custom_text, applicable_location, applicable_entity, use_legal_situational_context, use_entity_context, use_general_crypto_knowledge, profile_state],
         outputs=[status_output] + output_texts
     ).success(
         fn=ask_question,
-        inputs=[question_input, agents, decision_mode, custom_text, applicable_location, applicable_entity, use_legal_situational_context, use_entity_context, use_general_crypto_knowledge],
+        inputs=[question_input, agents, decision_mode, custom_text, applicable_location, applicable_entity, use_legal_situational_context, use_entity_context, use_general_crypto_knowledge, profile_state],
         outputs=output_texts
     )
 
-    refresh_history_button.click(fn=display_history, outputs=[history_output])
+    stop_button.click(fn=stop_query)
+
+    history_filters = [history_date_from, history_date_to, history_agent, history_pdf]
+    refresh_history_button.click(fn=display_history, inputs=[profile_state] + history_filters, outputs=[history_output, history_cursor, load_more_history_button])
+    load_more_history_button.click(fn=load_more_history, inputs=[profile_state, history_output, history_cursor] + history_filters, outputs=[history_output, history_cursor, load_more_history_button])
 
     create_profile_btn.click(
         fn=create_profile,
@@ -589,16 +1438,18 @@ with gr.Blocks(css="""
 
     delete_profile_btn.click(
         fn=delete_profile,
-        inputs=[profile_select],
-        outputs=[profile_select, status_output]
+        inputs=[profile_select, profile_state],
+        outputs=[profile_select, status_output, profile_state]
     )
 
     reload_profiles_btn.click(fn=reload_profiles, outputs=[profile_select])
 
+    refresh_diagnostics_button.click(fn=diagnostics_rows, outputs=[diagnostics_output])
+
     profile_select.change(
         fn=switch_profile,
         inputs=[profile_select],
-        outputs=[agents, decision_mode, custom_text, question_input, applicable_location, applicable_entity, use_legal_situational_context, use_entity_context, use_general_crypto_knowledge, status_output, pdf_files] + output_texts
+        outputs=[agents, decision_mode, custom_text, question_input, applicable_location, applicable_entity, use_legal_situational_context, use_entity_context, use_general_crypto_knowledge, retrieval_mode, agent_call_mode, agent_models, status_output, pdf_files] + output_texts + [profile_state]
     )
 
     def update_agents(agents):
@@ -612,20 +1463,29 @@ with gr.Blocks(css="""
         outputs=[agents]
     )
 
-    agents.change(fn=save_agents, inputs=[agents], outputs=[])
-    decision_mode.change(fn=save_decision_mode, inputs=[decision_mode], outputs=[])
-    custom_text.change(fn=save_custom_text, inputs=[custom_text], outputs=[])
-    applicable_location.change(fn=save_applicable_location, inputs=[applicable_location], outputs=[])
-    applicable_entity.change(fn=save_applicable_entity, inputs=[applicable_entity], outputs=[])
-    use_legal_situational_context.change(fn=save_use_legal_situational_context, inputs=[use_legal_situational_context], outputs=[])
-    use_entity_context.change(fn=save_use_entity_context, inputs=[use_entity_context], outputs=[])
-    use_general_crypto_knowledge.change(fn=save_use_general_crypto_knowledge, inputs=[use_general_crypto_knowledge], outputs=[])
+    agents.change(fn=save_agents, inputs=[agents, profile_state], outputs=[])
+    decision_mode.change(fn=save_decision_mode, inputs=[decision_mode, profile_state], outputs=[])
+    custom_text.change(fn=save_custom_text, inputs=[custom_text, profile_state], outputs=[])
+    applicable_location.change(fn=save_applicable_location, inputs=[applicable_location, profile_state], outputs=[])
+    applicable_entity.change(fn=save_applicable_entity, inputs=[applicable_entity, profile_state], outputs=[])
+    use_legal_situational_context.change(fn=save_use_legal_situational_context, inputs=[use_legal_situational_context, profile_state], outputs=[])
+    use_entity_context.change(fn=save_use_entity_context, inputs=[use_entity_context, profile_state], outputs=[])
+    use_general_crypto_knowledge.change(fn=save_use_general_crypto_knowledge, inputs=[use_general_crypto_knowledge, profile_state], outputs=[])
+    retrieval_mode.change(fn=save_retrieval_mode, inputs=[retrieval_mode, profile_state], outputs=[])
+    agent_call_mode.change(fn=save_agent_call_mode, inputs=[agent_call_mode, profile_state], outputs=[])
+    agent_models.input(fn=save_agent_models, inputs=[agent_models, profile_state], outputs=[])
 
     # Initialize the app
-    demo.load(fn=initialize_app, outputs=[profile_select])
+    demo.load(fn=initialize_app, outputs=[profile_select, profile_state])
 
 if __name__ == "__main__":
     load_profiles()  # Load profiles before launching the app
-    demo.queue()
+    if METRICS_PORT:
+        try:
+            start_metrics_server(METRICS_PORT, METRICS_HOST)
+            print(f"Serving metrics on port {METRICS_PORT} at /metrics")
+        except OSError as e:
+            print(f"Could not start the metrics endpoint on port {METRICS_PORT}: {str(e)}")
+    demo.queue(default_concurrency_limit=QUEUE_CONCURRENCY)
     demo.launch(share=True)
 
@@ -0,0 +1,334 @@
+# doc_index.py
+
+import heapq
+import math
+import re
+import uuid
+import zlib
+from array import array
+from collections import Counter
+
+TOKEN_PATTERN = re.compile(r"\w+")
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+INDEX_VERSION = 5  # Bumped when the chunk layout or pickled form changes so stored indexes get rebuilt
+SHINGLE_WORDS = 5  # Near-duplicate detection compares chunks as sets of overlapping word 5-grams
+MINHASH_BINS = 64
+LSH_BANDS = 16  # 4 bins per band: chunks about 60% or more similar almost always share a band
+EMPTY_BIN = (1 << 64) - 1
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+def estimate_tokens(text):
+    # Rough count for Llama-style tokenizers, which average about four characters per token
+    return max(1, (len(text) + 3) // 4)
+
+def normalize_page(text):
+    return " ".join(text.split())
+
+def split_sentences(pages, max_tokens):
+    # Yields (page_number, sentence, tokens, start, end) for every sentence, 1-based pages, where
+    # start and end are byte offsets into the normalised pages joined by newlines (the TextStore
+    # layout). Sentences longer than max_tokens (tables, text without punctuation) are cut into
+    # word runs that fit. pages can be any iterable and is read one page at a time.
+    page_start = 0
+    for page_number, page_text in enumerate(pages, 1):
+        page_text = normalize_page(page_text)
+        position = page_start
+        for sentence in SENTENCE_BOUNDARY.split(page_text):
+            size = len(sentence.encode("utf-8"))
+            if not sentence:
+                continue
+            tokens = estimate_tokens(sentence)
+            if tokens <= max_tokens:
+                yield page_number, sentence, tokens, position, position + size
+                position += size + 1
+                continue
+            words = []
+            for word in sentence.split(" "):
+                if words and estimate_tokens(" ".join(words + [word])) > max_tokens:
+                    piece = " ".join(words)
+                    piece_size = len(piece.encode("utf-8"))
+                    yield page_number, piece, estimate_tokens(piece), position, position + piece_size
+                    position += piece_size + 1
+                    words = []
+                words.append(word)
+            if words:
+                piece = " ".join(words)
+                piece_size = len(piece.encode("utf-8"))
+                yield page_number, piece, estimate_tokens(piece), position, position + piece_size
+                position += piece_size + 1
+        page_start += len(page_text.encode("utf-8")) + 1
+
+def minhash(text, bins=MINHASH_BINS):
+    # One-permutation MinHash of the text's word shingles: each shingle is hashed once (CRC-32, which
+    # is stable across processes, unlike hash()) and kept if it is the smallest in its bin. Bins no
+    # shingle fell into hold EMPTY_BIN.
+    words = tokenize(text)
+    signature = array("Q", [EMPTY_BIN] * bins)
+    for i in range(max(1, len(words) - SHINGLE_WORDS + 1) if words else 0):
+        value = zlib.crc32(" ".join(words[i:i + SHINGLE_WORDS]).encode("utf-8"))
+        bin_number, value = value % bins, value // bins
+        if value < signature[bin_number]:
+            signature[bin_number] = value
+    return signature
+
+def minhash_similarity(first, second):
+    # Estimated Jaccard similarity of the two shingle sets
+    filled = sum(1 for a, b in zip(first, second) if a != EMPTY_BIN or b != EMPTY_BIN)
+    if not filled:
+        return 0.0
+    return sum(1 for a, b in zip(first, second) if a == b != EMPTY_BIN) / filled
+
+def chunk_pages(pages, chunk_tokens, overlap_tokens):
+    # Packs whole sentences into chunks of up to chunk_tokens. Each chunk repeats up to
+    # overlap_tokens of trailing sentences from the previous one, and records its page span,
+    # sentence range (so overlapping chunks can be told apart at retrieval time) and byte range.
+    # Chunks are yielded as the pages are read, holding only the sentences of the current chunk.
+    sentences = split_sentences(pages, chunk_tokens)
+    window = []  # Sentences numbered from `first` on
+    first = 0
+
+    def available(number):
+        # Reads ahead until sentence `number` is in the window; False past the end of the document
+        while number - first >= len(window):
+            sentence = next(sentences, None)
+            if sentence is None:
+                return False
+            window.append(sentence)
+        return True
+
+    start = 0
+    while available(start):
+        end = start
+        total = 0
+        while available(end) and (end == start or total + window[end - first][2] <= chunk_tokens):
+            total += window[end - first][2]
+            end += 1
+        yield {
+            "text": " ".join(sentence[1] for sentence in window[start - first:end - first]),
+            "page": window[start - first][0],
+            "end_page": window[end - 1 - first][0],
+            "start": start,
+            "end": end,
+            "offset": window[start - first][3],
+            "size": window[end - 1 - first][4] - window[start - first][3]
+        }
+        if not available(end):
+            break
+        next_start = end
+        overlap = 0
+        while next_start - 1 > start and overlap + window[next_start - 1 - first][2] <= overlap_tokens:
+            next_start -= 1
+            overlap += window[next_start - first][2]
+        del window[:next_start - first]
+        first = start = next_start
+
+def format_chunk(chunk):
+    pages = f"page {chunk['page']}" if chunk["page"] == chunk["end_page"] else f"pages {chunk['page']}-{chunk['end_page']}"
+    return f"[PDF: {chunk['doc']}, {pages}]\n{chunk['text']}\n[End of {chunk['doc']}, {pages}]"
+
+def pack_chunks(index, ranked, token_budget):
+    # Greedily takes the best-ranked chunks that fit the token budget, skipping any chunk that
+    # shares sentences with one already taken. The top chunk is always included. Returned chunks
+    # carry their text, read from the text store where the index keeps offsets only.
+    selected = []
+    used = 0
+    for chunk_id, score in ranked:
+        chunk = index.chunks.get(chunk_id)  # Ranked outside the index lock, so the chunk may be gone
+        if chunk is None or "duplicate_of" in chunk or any(other["doc"] == chunk["doc"] and other["start"] < chunk["end"] and chunk["start"] < other["end"] for other in selected):
+            continue
+        chunk = dict(chunk, text=index.chunk_text(chunk_id))
+        tokens = estimate_tokens(format_chunk(chunk))
+        if selected and used + tokens > token_budget:
+            continue
+        selected.append(chunk)
+        used += tokens
+        if used >= token_budget:
+            break
+    return selected
+
+class BM25Index:
+    # Inverted index over sentence-aligned chunks of each document, scored with Okapi BM25.
+    # Documents can be added and removed individually so the index can be kept with
+    # the profile and updated when its PDFs change instead of being rebuilt per query. Given a
+    # text store, documents added with their digest keep only byte offsets per chunk and the
+    # text is read back from the store when a chunk is used.
+    # With a duplicate_threshold, a chunk whose MinHash similarity to an indexed chunk (found
+    # through LSH buckets) reaches the threshold is collapsed into it: it keeps its place in its
+    # document but gets no postings, so repeated passages (disclaimers, tokenomics tables copied
+    # between whitepapers) are retrieved, embedded and packed into a context only once.
+    def __init__(self, chunk_tokens=350, overlap_tokens=50, k1=1.5, b=0.75, text_store=None, duplicate_threshold=None):
+        self.version = INDEX_VERSION
+        self.uid = uuid.uuid4().hex  # Lets derived data (e.g. embeddings) detect a rebuilt index
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.k1 = k1
+        self.b = b
+        self.text_store = text_store
+        self.duplicate_threshold = duplicate_threshold
+        # chunk_id -> {"doc", "page", "end_page", "start", "end", "offset", "size", "length", "terms" ((term, frequency) pairs)}
+        # plus "digest" when the text is in the store, or "text" when it is kept inline, and
+        # "duplicate_of" for a collapsed chunk
+        self.chunks = {}
+        self.postings = {}    # term -> {chunk_id: term frequency}, indexed chunks only
+        self.doc_chunks = {}  # document name -> [chunk_id, ...]
+        self.total_length = 0
+        self.next_id = 0
+        self.signatures = {}   # chunk_id -> MinHash signature
+        self.lsh_buckets = {}  # (band, band bytes) -> [indexed chunk_id, ...]
+        self.duplicates = {}   # indexed chunk_id -> [chunk_ids collapsed into it]
+        self.duplicate_count = 0
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def add_document(self, name, pages, digest=None):
+        self.add_prepared(name, self.prepare_document(pages, digest))
+
+    def prepare_document(self, pages, digest=None):
+        # The costly half of add_document: chunking, tokenising and MinHashing a document. It only
+        # reads the index's settings, so callers can run it without the lock that guards the index
+        # and hold the lock just for add_prepared. pages can be any iterable. With a digest and a
+        # text store the pages are chunked as they are read back from the store, so a document of
+        # any length is read a page at a time.
+        if digest is not None and self.text_store is not None:
+            if not self.text_store.exists(digest):
+                self.text_store.put(digest, pages)
+            pages = self.text_store.iter_pages(digest)
+        return [self._prepare_chunk(chunk, digest) for chunk in chunk_pages(pages, self.chunk_tokens, self.overlap_tokens)]
+
+    def add_prepared(self, name, prepared):
+        # Merges chunks from prepare_document into the index, replacing any earlier version of the document
+        if name in self.doc_chunks:
+            self.remove_document(name)
+        self.doc_chunks[name] = [self._add_chunk(name, chunk, signature) for chunk, signature in prepared]
+
+    def remove_document(self, name):
+        removed = set(self.doc_chunks.pop(name, []))
+        for chunk_id in removed:
+            chunk = self.chunks.pop(chunk_id)
+            signature = self.signatures.pop(chunk_id, None)
+            if "duplicate_of" in chunk:
+                collapsed = self.duplicates.get(chunk["duplicate_of"])
+                if collapsed is not None:
+                    collapsed.remove(chunk_id)
+                    if not collapsed:
+                        del self.duplicates[chunk["duplicate_of"]]
+                self.duplicate_count -= 1
+                continue
+            self._unindex_chunk(chunk_id, chunk, signature)
+            # A copy left in another document takes the removed chunk's place in the index
+            survivors = [other for other in self.duplicates.pop(chunk_id, []) if other not in removed]
+            if survivors:
+                promoted = survivors[0]
+                del self.chunks[promoted]["duplicate_of"]
+                self.duplicate_count -= 1
+                self._index_chunk(promoted)
+                for other in survivors[1:]:
+                    self.chunks[other]["duplicate_of"] = promoted
+                if survivors[1:]:
+                    self.duplicates[promoted] = survivors[1:]
+
+    def _prepare_chunk(self, chunk, digest=None):
+        counts = Counter(tokenize(chunk["text"]))
+        signature = minhash(chunk["text"]) if self.duplicate_threshold else None
+        if digest is not None and self.text_store is not None:
+            chunk = {key: value for key, value in chunk.items() if key != "text"}
+            chunk["digest"] = digest
+        return dict(chunk, length=sum(counts.values()), terms=tuple(counts.items())), signature
+
+    def _add_chunk(self, name, chunk, signature):
+        chunk_id = self.next_id
+        self.next_id += 1
+        self.chunks[chunk_id] = dict(chunk, doc=name)
+        if signature is not None:
+            self.signatures[chunk_id] = signature
+            original = self._find_duplicate(signature)
+            if original is not None:
+                self.chunks[chunk_id]["duplicate_of"] = original
+                self.duplicates.setdefault(original, []).append(chunk_id)
+                self.duplicate_count += 1
+                return chunk_id
+        self._index_chunk(chunk_id)
+        return chunk_id
+
+    def _index_chunk(self, chunk_id):
+        chunk = self.chunks[chunk_id]
+        for term, frequency in chunk["terms"]:
+            self.postings.setdefault(term, {})[chunk_id] = frequency
+        self.total_length += chunk["length"]
+        signature = self.signatures.get(chunk_id)
+        if signature is not None:
+            for key in self._band_keys(signature):
+                self.lsh_buckets.setdefault(key, []).append(chunk_id)
+
+    def _unindex_chunk(self, chunk_id, chunk, signature):
+        for term, _ in chunk["terms"]:
+            posting = self.postings[term]
+            del posting[chunk_id]
+            if not posting:
+                del self.postings[term]
+        self.total_length -= chunk["length"]
+        if signature is not None:
+            for key in self._band_keys(signature):
+                bucket = self.lsh_buckets[key]
+                bucket.remove(chunk_id)
+                if not bucket:
+                    del self.lsh_buckets[key]
+
+    def _band_keys(self, signature):
+        rows = len(signature) // LSH_BANDS
+        for band in range(LSH_BANDS):
+            values = signature[band * rows:(band + 1) * rows]
+            if any(value != EMPTY_BIN for value in values):
+                yield band, values.tobytes()
+
+    def _find_duplicate(self, signature):
+        # The first indexed chunk sharing an LSH band whose estimated similarity reaches the threshold
+        checked = set()
+        for key in self._band_keys(signature):
+            for chunk_id in self.lsh_buckets.get(key, ()):
+                if chunk_id in checked:
+                    continue
+                checked.add(chunk_id)
+                if minhash_similarity(signature, self.signatures[chunk_id]) >= self.duplicate_threshold:
+                    return chunk_id
+        return None
+
+    def retrievable_chunks(self):
+        # Sorted ids of the chunks retrieval can return, i.e. every chunk not collapsed into another
+        return sorted(chunk_id for chunk_id, chunk in self.chunks.items() if "duplicate_of" not in chunk)
+
+    def chunk_text(self, chunk_id):
+        return self.read_chunk(self.chunks[chunk_id])
+
+    def read_chunk(self, chunk):
+        # Also takes a copy of the chunk, so its text can be read after the index may have changed
+        if "text" in chunk:
+            return chunk["text"]
+        return self.text_store.read(chunk["digest"], chunk["offset"], chunk["size"])
+
+    def score(self, query):
+        chunk_count = len(self.chunks) - self.duplicate_count
+        if not chunk_count:
+            return {}
+        average_length = self.total_length / chunk_count or 1
+        scores = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (chunk_count - len(posting) + 0.5) / (len(posting) + 0.5))
+            for chunk_id, frequency in posting.items():
+                length_norm = 1 - self.b + self.b * self.chunks[chunk_id]["length"] / average_length
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+        return scores
+
+    def search(self, query, top_k=1):
+        # Returns [(chunk_id, score)], best first
+        scores = self.score(query)
+        if not scores:
+            # Nothing matched: fall back to the start of the corpus like the old chunk scan did
+            return [(chunk_id, 0.0) for chunk_id in self.retrievable_chunks()[:top_k]]
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
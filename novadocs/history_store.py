@@ -0,0 +1,79 @@
+# history_store.py
+
+import json
+import sqlite3
+
+class HistoryStore:
+    # Query history kept in SQLite, scoped per profile. Pages are fetched newest first with keyset
+    # pagination (id < cursor), and agents and PDFs live in their own indexed tables, so fetching or
+    # filtering a page costs the same however long the history gets.
+    def __init__(self, db_path):
+        self.db_path = db_path
+        with self.connect() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    profile TEXT NOT NULL,
+                    timestamp TEXT NOT NULL,
+                    entry TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS history_profile_id ON history (profile, id);
+                CREATE INDEX IF NOT EXISTS history_profile_timestamp ON history (profile, timestamp);
+                CREATE TABLE IF NOT EXISTS history_agents (
+                    history_id INTEGER NOT NULL REFERENCES history (id) ON DELETE CASCADE,
+                    agent TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS history_agents_lookup ON history_agents (history_id, agent);
+                CREATE TABLE IF NOT EXISTS history_pdfs (
+                    history_id INTEGER NOT NULL REFERENCES history (id) ON DELETE CASCADE,
+                    pdf TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS history_pdfs_lookup ON history_pdfs (history_id, pdf);
+            """)
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute("PRAGMA foreign_keys = ON")
+        return conn
+
+    def add(self, profile_name, entry):
+        with self.connect() as conn:
+            history_id = conn.execute(
+                "INSERT INTO history (profile, timestamp, entry) VALUES (?, ?, ?)",
+                (profile_name, entry["timestamp"], json.dumps(entry))
+            ).lastrowid
+            conn.executemany("INSERT INTO history_agents (history_id, agent) VALUES (?, ?)", [(history_id, agent) for agent in entry["agents"]])
+            conn.executemany("INSERT INTO history_pdfs (history_id, pdf) VALUES (?, ?)", [(history_id, pdf) for pdf in entry["pdfs_used"]])
+        return history_id
+
+    def page(self, profile_name, limit=10, before_id=None, date_from=None, date_to=None, agent=None, pdf=None):
+        # Returns up to `limit` entries, newest first, each with its "id"; pass the last id back as
+        # before_id to load the next page. Dates are inclusive "YYYY-MM-DD" strings.
+        conditions = ["profile = ?"]
+        params = [profile_name]
+        if before_id is not None:
+            conditions.append("id < ?")
+            params.append(before_id)
+        if date_from:
+            conditions.append("timestamp >= ?")
+            params.append(date_from)
+        if date_to:
+            conditions.append("timestamp <= ?")
+            params.append(f"{date_to} 23:59:59")
+        if agent:
+            conditions.append("EXISTS (SELECT 1 FROM history_agents WHERE history_id = history.id AND agent = ?)")
+            params.append(agent)
+        if pdf:
+            conditions.append("EXISTS (SELECT 1 FROM history_pdfs WHERE history_id = history.id AND pdf = ?)")
+            params.append(pdf)
+        params.append(limit)
+        with self.connect() as conn:
+            rows = conn.execute(
+                f"SELECT id, entry FROM history WHERE {' AND '.join(conditions)} ORDER BY id DESC LIMIT ?",
+                params
+            ).fetchall()
+        return [dict(json.loads(entry), id=history_id) for history_id, entry in rows]
+
+    def delete_profile(self, profile_name):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM history WHERE profile = ?", (profile_name,))
@@ -0,0 +1,98 @@
+# llm_cache.py
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+def cache_key(payload):
+    # Hash of everything that determines the answer: model, full prompt and generation options
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+def tag_directory_name(tag):
+    return hashlib.sha256(str(tag).encode("utf-8")).hexdigest()[:16]
+
+class ResponseCache:
+    # Two-tier cache of finished LLM responses: an in-memory LRU in front of a directory of JSON
+    # files that is trimmed back to max_disk_bytes, least recently used first. Entries are grouped
+    # by tag (the profile name) so everything cached for a profile can be dropped at once when
+    # its PDFs change.
+    def __init__(self, directory, memory_entries=256, max_disk_bytes=100 * 1024 * 1024):
+        self.directory = directory
+        self.memory_entries = memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()  # (tag, key) -> response
+        self.disk = {}  # path -> [last access time, size]
+        self.disk_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        for tag_dir in os.listdir(directory):
+            tag_path = os.path.join(directory, tag_dir)
+            if not os.path.isdir(tag_path):
+                continue
+            for entry in os.listdir(tag_path):
+                path = os.path.join(tag_path, entry)
+                stat = os.stat(path)
+                self.disk[path] = [stat.st_mtime, stat.st_size]
+                self.disk_bytes += stat.st_size
+
+    def path(self, tag, key):
+        return os.path.join(self.directory, tag_directory_name(tag), f"{key}.json")
+
+    def get(self, tag, key):
+        with self.lock:
+            if (tag, key) in self.memory:
+                self.memory.move_to_end((tag, key))
+                return self.memory[(tag, key)]
+            path = self.path(tag, key)
+            if path not in self.disk:
+                return None
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    response = json.load(f)["response"]
+            except (OSError, ValueError, KeyError):
+                return None
+            now = time.time()
+            self.disk[path][0] = now
+            os.utime(path, (now, now))  # Keeps LRU order across restarts
+            self._remember(tag, key, response)
+            return response
+
+    def put(self, tag, key, response):
+        data = json.dumps({"response": response}).encode("utf-8")
+        path = self.path(tag, key)
+        with self.lock:
+            self._remember(tag, key, response)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+            if path in self.disk:
+                self.disk_bytes -= self.disk[path][1]
+            self.disk[path] = [time.time(), len(data)]
+            self.disk_bytes += len(data)
+            if self.disk_bytes > self.max_disk_bytes:
+                for old_path, (accessed, size) in sorted(self.disk.items(), key=lambda item: item[1][0]):
+                    if self.disk_bytes <= self.max_disk_bytes:
+                        break
+                    if os.path.exists(old_path):
+                        os.remove(old_path)
+                    del self.disk[old_path]
+                    self.disk_bytes -= size
+
+    def invalidate(self, tag):
+        tag_path = os.path.join(self.directory, tag_directory_name(tag))
+        with self.lock:
+            for memory_key in [memory_key for memory_key in self.memory if memory_key[0] == tag]:
+                del self.memory[memory_key]
+            for path in [path for path in self.disk if os.path.dirname(path) == tag_path]:
+                self.disk_bytes -= self.disk.pop(path)[1]
+            shutil.rmtree(tag_path, ignore_errors=True)
+
+    def _remember(self, tag, key, response):
+        self.memory[(tag, key)] = response
+        self.memory.move_to_end((tag, key))
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
@@ -0,0 +1,119 @@
+# metrics.py
+
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+class Histogram:
+    # Cumulative-bucket histogram per label combination, rendered in the Prometheus text format
+    def __init__(self, name, help_text, label_names=(), buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.series = {}  # label values -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self.lock:
+            series = self.series.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[len(self.buckets)] += 1
+            series[-1] += value
+
+    def quantile(self, fraction, series):
+        # Linear interpolation inside the bucket holding the quantile, like PromQL's histogram_quantile
+        count = series[len(self.buckets)]
+        if not count:
+            return None
+        rank = fraction * count
+        lower_bound, lower_count = 0.0, 0
+        for bound, cumulative in zip(self.buckets, series):
+            if cumulative >= rank:
+                if cumulative == lower_count:
+                    return bound
+                return lower_bound + (bound - lower_bound) * (rank - lower_count) / (cumulative - lower_count)
+            lower_bound, lower_count = bound, cumulative
+        return self.buckets[-1]
+
+    def summary(self):
+        # [(labels dict, count, mean, p50, p95)] for every series, for the diagnostics panel
+        with self.lock:
+            items = sorted((key, list(series)) for key, series in self.series.items())
+        rows = []
+        for key, series in items:
+            count = series[len(self.buckets)]
+            rows.append((dict(zip(self.label_names, key)), count, series[-1] / count if count else None, self.quantile(0.5, series), self.quantile(0.95, series)))
+        return rows
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            items = sorted((key, list(series)) for key, series in self.series.items())
+        for key, series in items:
+            labels = ",".join(f'{name}="{value}"' for name, value in zip(self.label_names, key))
+            prefix = f"{labels}," if labels else ""
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {series[len(self.buckets)]}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series[-1]}")
+            lines.append(f"{self.name}_count{{{labels}}} {series[len(self.buckets)]}")
+        return "\n".join(lines)
+
+stage_seconds = Histogram("novadocs_stage_seconds", "Wall-clock time per NovaDocs processing stage.", ["stage"])
+ollama_seconds = Histogram("novadocs_ollama_seconds", "Ollama-reported durations per call kind (prompt_eval or eval) and phase.", ["kind", "phase"])
+ollama_tokens = Histogram("novadocs_ollama_tokens", "Ollama-reported token counts per call kind (prompt_eval or eval) and phase.", ["kind", "phase"], TOKEN_BUCKETS)
+HISTOGRAMS = [stage_seconds, ollama_seconds, ollama_tokens]
+
+@contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - started, stage=stage)
+
+def observe_ollama_stats(kind, stats):
+    # Ollama reports durations in nanoseconds on the final streamed message. Returns the durations
+    # recorded, in seconds by phase, so callers can log the same values.
+    seconds = {}
+    for phase in ("prompt_eval", "eval"):
+        if f"{phase}_duration" in stats:
+            seconds[phase] = stats[f"{phase}_duration"] / 1e9
+            ollama_seconds.observe(seconds[phase], kind=kind, phase=phase)
+        if f"{phase}_count" in stats:
+            ollama_tokens.observe(stats[f"{phase}_count"], kind=kind, phase=phase)
+    return seconds
+
+def render_metrics():
+    return "\n".join(histogram.render() for histogram in HISTOGRAMS) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        data = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def start_metrics_server(port, host="127.0.0.1"):
+    # Serves /metrics for Prometheus from a daemon thread next to the Gradio server. Only local
+    # scrapers can reach it unless host is set to an outside interface (e.g. 0.0.0.0).
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="novadocs-metrics", daemon=True).start()
+    return server
@@ -0,0 +1,52 @@
+# partial_json.py
+
+import json
+import re
+
+def read_json_string(text, position):
+    # Reads the JSON string starting at the first quote at or after position. Returns (value, end),
+    # with end None while the string is still open, or (None, None) if no string has started.
+    start = text.find('"', position)
+    if start < 0:
+        return None, None
+    i = start + 1
+    while i < len(text):
+        if text[i] == "\\":
+            i += 2
+            continue
+        if text[i] == '"':
+            try:
+                return json.loads(text[start:i + 1]), i + 1
+            except ValueError:
+                return text[start + 1:i], i + 1
+        i += 1
+    raw = text[start + 1:]
+    if (len(raw) - len(raw.rstrip("\\"))) % 2:
+        raw = raw[:-1]  # Escape cut off mid-stream
+    raw = re.sub(r'\\u[0-9a-fA-F]{0,3}$', '', raw)
+    try:
+        return json.loads(f'"{raw}"'), None
+    except ValueError:
+        return raw, None
+
+def partial_json_fields(text):
+    # {field: text so far} from a streamed, possibly incomplete JSON object of string fields
+    fields = {}
+    position = text.find("{")
+    if position < 0:
+        return fields
+    position += 1
+    while True:
+        key, position = read_json_string(text, position)
+        if key is None or position is None:
+            break
+        colon = text.find(":", position)
+        if colon < 0:
+            break
+        value, position = read_json_string(text, colon + 1)
+        if value is None:
+            break
+        fields[key] = value
+        if position is None:
+            break
+    return fields
@@ -0,0 +1,160 @@
+# pdf_extract.py
+
+import hashlib
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from PyPDF2 import PdfReader
+from text_store import shared_store
+
+EXTRACT_WORKERS = os.cpu_count() or 1
+PAGES_PER_TASK = 50  # Large PDFs are split into page ranges of this size and extracted in parallel
+# Page ranges being extracted or waiting for an earlier range of their PDF; bounds ingest memory
+MAX_PENDING_RANGES = EXTRACT_WORKERS * 2
+# Extracted pages keyed by the SHA-256 of the PDF bytes, shared by all profiles
+EXTRACT_CACHE_DIR = "extract_cache"
+
+extracted_texts = shared_store(EXTRACT_CACHE_DIR)
+
+_executor = None
+
+def get_executor():
+    # One long-lived pool so worker start-up is only paid on the first batch
+    global _executor
+    if _executor is None:
+        # Workers are started from a clean server process rather than forked from this one, whose
+        # other threads (Gradio, uvicorn, ingests) may hold locks a forked child would inherit held
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _executor = ProcessPoolExecutor(max_workers=EXTRACT_WORKERS, mp_context=multiprocessing.get_context(start_method))
+    return _executor
+
+_worker_reader = {}  # In a worker process: (path, size, mtime) -> (open file, reader) of the PDF it last read
+
+def open_reader(path):
+    # Readers can't be pickled, so each worker opens its own and keeps it for the following ranges,
+    # which are usually from the same PDF. It reads from the file handle, seeking to the objects
+    # it needs, rather than from a copy of the whole file in memory as PdfReader(path) would.
+    info = os.stat(path)
+    key = (path, info.st_size, info.st_mtime_ns)
+    if key not in _worker_reader:
+        for file, _ in _worker_reader.values():
+            file.close()
+        _worker_reader.clear()
+        file = open(path, "rb")
+        try:
+            _worker_reader[key] = (file, PdfReader(file))
+        except BaseException:
+            file.close()
+            raise
+    return _worker_reader[key][1]
+
+def extract_page_range(path, start, end):
+    # Runs in a worker process
+    reader = open_reader(path)
+    return [reader.pages[i].extract_text() or "" for i in range(start, end)]
+
+def extract_pdfs(documents, pages_per_task=PAGES_PER_TASK, max_pending=MAX_PENDING_RANGES):
+    # documents maps each PDF path to its SHA-256. Page ranges are extracted on the process pool and
+    # appended to extracted_texts in page order as they arrive, with at most max_pending ranges in
+    # flight or held back waiting for an earlier one, so memory stays bounded however long the PDFs
+    # are. Progress is checkpointed after every range and a PDF whose extraction was interrupted
+    # resumes from its checkpoint. Yields (path, pages_done, page_count, error) as ranges are stored;
+    # pages_done == page_count once a PDF is complete and readable from the store.
+    executor = get_executor()
+    waiting = list(documents)
+    states = {}  # path -> {"writer", "page_count", "next" (first page not yet submitted), "ranges" (held back)}
+    futures = {}
+    try:
+        while True:
+            # Fill the window, moving on to the next PDF once every range of the current ones is submitted
+            while len(futures) + sum(len(state["ranges"]) for state in states.values()) < max_pending:
+                path = next((path for path, state in states.items() if state["next"] < state["page_count"]), None)
+                if path is None:
+                    if not waiting:
+                        break
+                    # A PDF another ingest is extracting is left for later. This ingest only waits for
+                    # it once it holds no writer of its own, so two ingests can't wait on each other.
+                    writer = None
+                    for path in waiting:
+                        writer = extracted_texts.writer(documents[path], blocking=False)
+                        if writer is not None:
+                            break
+                    if writer is None:
+                        if futures:
+                            break
+                        path = waiting[0]
+                        writer = extracted_texts.writer(documents[path])
+                    waiting.remove(path)
+                    try:
+                        if extracted_texts.exists(documents[path]):
+                            # The other ingest finished it while this one waited
+                            writer.close()
+                            page_count = extracted_texts.page_count(documents[path])
+                            yield path, page_count, page_count, None
+                            continue
+                        with open(path, "rb") as file:
+                            page_count = len(PdfReader(file).pages)
+                        if writer.page_count > page_count:
+                            writer.reset()
+                    except Exception as e:
+                        writer.close()
+                        yield path, 0, 0, e
+                        continue
+                    if writer.page_count == page_count:
+                        writer.commit()
+                        yield path, page_count, page_count, None
+                        continue
+                    states[path] = {"writer": writer, "page_count": page_count, "next": writer.page_count, "ranges": {}}
+                    if writer.page_count:
+                        print(f"Resuming extraction of {os.path.basename(path)} from page {writer.page_count + 1}")
+                        yield path, writer.page_count, page_count, None
+                    continue
+                state = states[path]
+                end = min(state["next"] + pages_per_task, state["page_count"])
+                futures[executor.submit(extract_page_range, path, state["next"], end)] = (path, state["next"])
+                state["next"] = end
+            if not futures:
+                break
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, start = futures.pop(future)
+                state = states.get(path)
+                if state is None:
+                    continue  # An earlier range of this file already failed
+                writer = state["writer"]
+                try:
+                    state["ranges"][start] = future.result()
+                except Exception as e:
+                    writer.close()
+                    del states[path]
+                    yield path, writer.page_count, state["page_count"], e
+                    continue
+                if writer.page_count not in state["ranges"]:
+                    continue
+                while writer.page_count in state["ranges"]:
+                    for page in state["ranges"].pop(writer.page_count):
+                        writer.append(page)
+                writer.checkpoint()
+                if writer.page_count == state["page_count"]:
+                    writer.commit()
+                    del states[path]
+                yield path, writer.page_count, state["page_count"], None
+    finally:
+        # Drop queued work if the caller stopped early (e.g. on the first error); stored pages stay checkpointed
+        for future in futures:
+            future.cancel()
+        for state in states.values():
+            state["writer"].close()
+
+def extract_file(file):
+    # Extracts a PDF page by page in this process, for the odd document that isn't worth the pool
+    for page in PdfReader(file).pages:
+        yield page.extract_text() or ""
+
+def file_sha256(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
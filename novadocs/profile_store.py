@@ -0,0 +1,71 @@
+# profile_store.py
+
+import pickle
+import sqlite3
+import threading
+
+class ProfileStore:
+    # SQLite-backed profile storage. Every profile field is its own row, so saving a changed
+    # checkbox rewrites one small value instead of the whole profile. Changed fields are
+    # serialized straight away, kept as dirty and written together after a short debounce
+    # delay, so a burst of keystrokes in a textbox ends up as a single write.
+    def __init__(self, db_path, debounce_seconds=1.0):
+        self.db_path = db_path
+        self.debounce_seconds = debounce_seconds
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()  # Keeps overlapping flushes from writing out of order
+        self.dirty = {}  # (profile, field) -> pickled value
+        self.timer = None
+        with self.connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS profile_fields (
+                profile TEXT NOT NULL,
+                field TEXT NOT NULL,
+                value BLOB NOT NULL,
+                PRIMARY KEY (profile, field)
+            )""")
+
+    def connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def profile_names(self):
+        self.flush()
+        with self.connect() as conn:
+            return [row[0] for row in conn.execute("SELECT profile FROM profile_fields GROUP BY profile ORDER BY MIN(rowid)")]
+
+    def load(self, profile_name):
+        self.flush()
+        with self.connect() as conn:
+            rows = conn.execute("SELECT field, value FROM profile_fields WHERE profile = ?", (profile_name,)).fetchall()
+        return {field: pickle.loads(value) for field, value in rows}
+
+    def set(self, profile_name, field, value):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.dirty[(profile_name, field)] = data
+            if self.timer is None:
+                self.timer = threading.Timer(self.debounce_seconds, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                dirty, self.dirty = self.dirty, {}
+            if not dirty:
+                return
+            with self.connect() as conn:
+                conn.executemany(
+                    "INSERT INTO profile_fields (profile, field, value) VALUES (?, ?, ?) "
+                    "ON CONFLICT (profile, field) DO UPDATE SET value = excluded.value",
+                    [(profile_name, field, value) for (profile_name, field), value in dirty.items()]
+                )
+
+    def delete(self, profile_name):
+        with self.write_lock:
+            with self.lock:
+                self.dirty = {key: value for key, value in self.dirty.items() if key[0] != profile_name}
+            with self.connect() as conn:
+                conn.execute("DELETE FROM profile_fields WHERE profile = ?", (profile_name,))
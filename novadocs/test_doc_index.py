@@ -0,0 +1,129 @@
+# test_doc_index.py
+
+import random
+
+from doc_index import BM25Index, minhash, minhash_similarity
+
+def sentences(seed, count):
+    # Sentences of random made-up words, so text from different seeds shares no shingles. Each
+    # sentence fills most of a chunk of make_index(), so every sentence is a chunk of its own.
+    generator = random.Random(seed)
+    return " ".join(" ".join(f"w{seed}x{generator.randrange(10 ** 6)}" for _ in range(25)) + "." for _ in range(count))
+
+DISCLAIMER = sentences("disclaimer", 1)
+
+def make_index():
+    return BM25Index(chunk_tokens=150, overlap_tokens=0, duplicate_threshold=0.8)
+
+def check_invariants(index):
+    indexed = [chunk_id for chunk_id, chunk in index.chunks.items() if "duplicate_of" not in chunk]
+    collapsed = [chunk_id for chunk_id, chunk in index.chunks.items() if "duplicate_of" in chunk]
+    assert sorted(chunk_id for chunk_ids in index.doc_chunks.values() for chunk_id in chunk_ids) == sorted(index.chunks)
+    assert index.duplicate_count == len(collapsed)
+    assert index.retrievable_chunks() == sorted(indexed)
+    # Collapsed chunks point at an indexed chunk that lists them, and nothing else does
+    assert sorted(chunk_id for chunk_ids in index.duplicates.values() for chunk_id in chunk_ids) == sorted(collapsed)
+    for original, chunk_ids in index.duplicates.items():
+        assert chunk_ids and original in indexed
+        assert all(index.chunks[chunk_id]["duplicate_of"] == original for chunk_id in chunk_ids)
+    # Postings, lengths and LSH buckets hold the indexed chunks only
+    postings = {}
+    for chunk_id in indexed:
+        for term, frequency in index.chunks[chunk_id]["terms"]:
+            postings.setdefault(term, {})[chunk_id] = frequency
+    assert index.postings == postings
+    assert index.total_length == sum(index.chunks[chunk_id]["length"] for chunk_id in indexed)
+    buckets = {}
+    for chunk_id in indexed:
+        for key in index._band_keys(index.signatures[chunk_id]):
+            buckets.setdefault(key, []).append(chunk_id)
+    assert {key: sorted(chunk_ids) for key, chunk_ids in index.lsh_buckets.items()} == {key: sorted(chunk_ids) for key, chunk_ids in buckets.items()}
+    assert sorted(index.signatures) == sorted(index.chunks)
+
+def disclaimer_hits(index):
+    # Documents whose chunk is returned for the disclaimer; only one copy is ever retrievable
+    return [index.chunks[chunk_id]["doc"] for chunk_id, score in index.search(DISCLAIMER, 10) if score > 0 and index.chunks[chunk_id]["text"] == DISCLAIMER]
+
+def test_minhash_similarity_of_identical_and_unrelated_text():
+    assert minhash_similarity(minhash(DISCLAIMER), minhash(DISCLAIMER)) == 1.0
+    assert minhash_similarity(minhash(DISCLAIMER), minhash(sentences("other", 1))) < 0.2
+    assert minhash_similarity(minhash(""), minhash("")) == 0.0
+
+def test_a_repeated_passage_is_collapsed_into_the_first_copy():
+    index = make_index()
+    for name in ("a.pdf", "b.pdf", "c.pdf"):
+        index.add_document(name, [sentences(name, 6), DISCLAIMER])
+    check_invariants(index)
+    assert index.duplicate_count == 2
+    assert disclaimer_hits(index) == ["a.pdf"]
+    assert len(index.duplicates) == 1
+
+def test_removing_the_original_promotes_a_surviving_copy():
+    index = make_index()
+    for name in ("a.pdf", "b.pdf", "c.pdf"):
+        index.add_document(name, [sentences(name, 6), DISCLAIMER])
+    index.remove_document("a.pdf")
+    check_invariants(index)
+    assert disclaimer_hits(index) == ["b.pdf"]
+    assert index.duplicate_count == 1
+    index.remove_document("b.pdf")
+    check_invariants(index)
+    assert disclaimer_hits(index) == ["c.pdf"]
+    assert index.duplicate_count == 0
+    index.remove_document("c.pdf")
+    check_invariants(index)
+    assert not index.chunks and not index.postings and not index.lsh_buckets and not index.duplicates
+
+def test_removing_a_copy_keeps_the_original():
+    index = make_index()
+    for name in ("a.pdf", "b.pdf", "c.pdf"):
+        index.add_document(name, [sentences(name, 6), DISCLAIMER])
+    index.remove_document("b.pdf")
+    check_invariants(index)
+    assert disclaimer_hits(index) == ["a.pdf"]
+    assert index.duplicates and index.duplicate_count == 1
+
+def test_a_document_repeating_its_own_passage():
+    # The original and its copy are removed together, so there is nothing to promote
+    index = make_index()
+    index.add_document("a.pdf", [DISCLAIMER, sentences("a.pdf", 6), DISCLAIMER])
+    index.add_document("b.pdf", [DISCLAIMER])
+    check_invariants(index)
+    index.remove_document("a.pdf")
+    check_invariants(index)
+    assert disclaimer_hits(index) == ["b.pdf"]
+
+def test_re_adding_a_document_replaces_its_chunks():
+    index = make_index()
+    index.add_document("a.pdf", [DISCLAIMER])
+    index.add_document("b.pdf", [DISCLAIMER])
+    index.add_document("a.pdf", [sentences("new", 6)])
+    check_invariants(index)
+    assert disclaimer_hits(index) == ["b.pdf"]
+
+def test_random_adds_and_removes_keep_the_index_consistent():
+    generator = random.Random(7)
+    passages = [sentences(f"passage{number}", 1) for number in range(4)]
+    index = make_index()
+    for step in range(200):
+        name = f"doc{generator.randrange(6)}.pdf"
+        if name in index.doc_chunks and generator.random() < 0.4:
+            index.remove_document(name)
+        else:
+            index.add_document(name, [generator.choice(passages) if generator.random() < 0.6 else sentences(f"{name}{step}", 6) for _ in range(generator.randint(1, 4))])
+        check_invariants(index)
+        # Every passage still in some document stays retrievable through exactly one chunk
+        present = set(chunk["text"] for chunk in index.chunks.values())
+        retrievable = [index.chunks[chunk_id]["text"] for chunk_id in index.retrievable_chunks()]
+        for passage in passages:
+            assert retrievable.count(passage) == (passage in present)
+
+def test_a_prepared_document_is_indexed_like_an_added_one():
+    added, prepared = make_index(), make_index()
+    for name in ("a.pdf", "b.pdf"):
+        pages = [sentences(name, 6), DISCLAIMER]
+        added.add_document(name, pages)
+        prepared.add_prepared(name, prepared.prepare_document(pages))
+    check_invariants(prepared)
+    assert prepared.chunks == added.chunks and prepared.postings == added.postings
+    assert prepared.duplicates == added.duplicates and disclaimer_hits(prepared) == ["a.pdf"]
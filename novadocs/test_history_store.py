@@ -0,0 +1,64 @@
+# test_history_store.py
+
+import pytest
+
+from history_store import HistoryStore
+
+def make_entry(number, agents=("General",), pdfs=("whitepaper.pdf",), day=1):
+    return {
+        "question": f"Question {number}",
+        "agents": list(agents),
+        "pdfs_used": list(pdfs),
+        "results": f"Answer {number}",
+        "timestamp": f"2026-01-{day:02d} 12:00:00"
+    }
+
+@pytest.fixture
+def store(tmp_path):
+    return HistoryStore(str(tmp_path / "history.db"))
+
+def all_pages(store, profile_name, limit, **filters):
+    pages = []
+    before_id = None
+    while True:
+        entries = store.page(profile_name, limit, before_id, **filters)
+        if entries:
+            pages.append(entries)
+        if len(entries) < limit:
+            return pages
+        before_id = entries[-1]["id"]
+
+def test_pages_are_newest_first_and_cover_every_entry_once(store):
+    ids = [store.add("Project X", make_entry(number)) for number in range(23)]
+    pages = all_pages(store, "Project X", 10)
+    assert [len(entries) for entries in pages] == [10, 10, 3]
+    assert [entry["id"] for entries in pages for entry in entries] == ids[::-1]
+    assert pages[0][0]["question"] == "Question 22"
+
+def test_entries_added_between_pages_do_not_shift_the_next_page(store):
+    ids = [store.add("Project X", make_entry(number)) for number in range(15)]
+    first = store.page("Project X", 5)
+    store.add("Project X", make_entry(99))
+    second = store.page("Project X", 5, first[-1]["id"])
+    assert [entry["id"] for entry in second] == ids[9:4:-1]
+
+def test_pages_only_hold_the_profiles_own_entries(store):
+    for number in range(6):
+        store.add("Project X" if number % 2 else "Project Y", make_entry(number))
+    assert [entry["question"] for entry in store.page("Project X", 10)] == ["Question 5", "Question 3", "Question 1"]
+    store.delete_profile("Project X")
+    assert store.page("Project X", 10) == []
+    assert len(store.page("Project Y", 10)) == 3
+
+def test_filters_page_through_matching_entries_only(store):
+    for number in range(30):
+        agents = ("General", "Equality") if number % 3 == 0 else ("General",)
+        pdfs = ("tokenomics.pdf",) if number % 2 == 0 else ("whitepaper.pdf",)
+        store.add("Project X", make_entry(number, agents, pdfs, day=number // 10 + 1))
+    by_agent = [entry["question"] for entries in all_pages(store, "Project X", 4, agent="Equality") for entry in entries]
+    assert by_agent == [f"Question {number}" for number in range(27, -1, -3)]
+    both = [entry["question"] for entries in all_pages(store, "Project X", 4, agent="Equality", pdf="tokenomics.pdf") for entry in entries]
+    assert both == [f"Question {number}" for number in range(24, -1, -6)]
+    # Dates are inclusive, so date_to covers the whole of its day
+    by_date = [entry["question"] for entries in all_pages(store, "Project X", 4, date_from="2026-01-02", date_to="2026-01-02") for entry in entries]
+    assert by_date == [f"Question {number}" for number in range(19, 9, -1)]
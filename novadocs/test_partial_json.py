@@ -0,0 +1,49 @@
+# test_partial_json.py
+
+import json
+
+from partial_json import partial_json_fields, read_json_string
+
+ANSWERS = {
+    "General": "- Staking pays \"up to\" 12% APY\n- Rewards vest over C:\\vesting\\schedule",
+    "Rule-breaking and Legality": "- Caf\u00e9 tokens: no licence \u2014 see [PDF: terms.pdf, page 3]",
+    "Equality": "No useful info from PDFs in this answer."
+}
+
+def test_complete_object_matches_json_loads():
+    for text in (json.dumps(ANSWERS), json.dumps(ANSWERS, indent=2), json.dumps(ANSWERS, ensure_ascii=False)):
+        assert partial_json_fields(text) == ANSWERS
+
+def test_every_prefix_gives_the_fields_so_far():
+    # Whatever point the stream is cut at, each field read is a prefix of its final text, and
+    # fields only appear once their key is complete
+    for text in (json.dumps(ANSWERS), json.dumps(ANSWERS, indent=2), json.dumps(ANSWERS, ensure_ascii=False)):
+        seen = []
+        for end in range(len(text) + 1):
+            fields = partial_json_fields(text[:end])
+            for key, value in fields.items():
+                assert key in ANSWERS
+                assert ANSWERS[key].startswith(value), (text[:end], key, value)
+            assert list(fields) == list(ANSWERS)[:len(fields)]
+            seen.append(len(fields))
+        assert seen == sorted(seen)
+
+def test_cut_escapes_are_dropped_until_complete():
+    assert partial_json_fields('{"General": "a\\') == {"General": "a"}
+    assert partial_json_fields('{"General": "a\\\\') == {"General": "a\\"}
+    assert partial_json_fields('{"General": "caf\\u00') == {"General": "caf"}
+    assert partial_json_fields('{"General": "caf\\u00e9') == {"General": "caf\u00e9"}
+    assert partial_json_fields('{"General": "say \\"hi') == {"General": "say \"hi"}
+
+def test_nothing_until_a_key_and_value_have_started():
+    assert partial_json_fields("") == {}
+    assert partial_json_fields("Error communicating with Ollama API") == {}
+    assert partial_json_fields('{"Gene') == {}
+    assert partial_json_fields('{"General"') == {}
+    assert partial_json_fields('{"General": ') == {}
+    assert partial_json_fields('{"General": "') == {"General": ""}
+
+def test_read_json_string_reports_where_the_string_ends():
+    assert read_json_string('x "a\\"b" y', 0) == ("a\"b", 8)
+    assert read_json_string('x "open', 0) == ("open", None)
+    assert read_json_string("no string", 0) == (None, None)
@@ -0,0 +1,178 @@
+# text_store.py
+
+import json
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from doc_index import normalize_page
+
+_shared_stores = {}  # root -> the TextStore every user of that directory shares
+_shared_stores_lock = threading.Lock()
+
+def shared_store(root, open_files=32):
+    # Writer locks only keep writers apart within one TextStore, so each directory has just one
+    with _shared_stores_lock:
+        if root not in _shared_stores:
+            _shared_stores[root] = TextStore(root, open_files)
+        return _shared_stores[root]
+
+class TextStore:
+    # Extracted PDF text, one flat UTF-8 file per document keyed by the SHA-256 of the PDF, with the
+    # byte offset of every page in a small JSON sidecar. Pages are normalised and joined by newlines,
+    # the layout doc_index records chunk offsets against, so retrieval reads a chunk's byte range
+    # from a memory map instead of every document's text being held in memory. Documents are written
+    # page by page through a TextWriter, so neither writing nor reading needs all of a document's pages.
+    def __init__(self, root, open_files=32):
+        self.root = root
+        self.open_files = open_files
+        self.lock = threading.Lock()
+        self.maps = OrderedDict()  # digest -> (mmap or None for an empty document, page offsets)
+        self.writer_locks = {}  # digest -> lock held by the one writer of that digest
+        os.makedirs(root, exist_ok=True)
+
+    def __reduce__(self):
+        # Indexes keep a reference to their store and are pickled with the profile. Unpickling gives
+        # them the shared store for the same root, with its open maps and writer locks, not a copy.
+        return shared_store, (self.root, self.open_files)
+
+    def text_path(self, digest):
+        return os.path.join(self.root, f"{digest}.txt")
+
+    def offsets_path(self, digest):
+        return os.path.join(self.root, f"{digest}.pages.json")
+
+    def checkpoint_path(self, digest):
+        return os.path.join(self.root, f"{digest}.partial.json")
+
+    def exists(self, digest):
+        return os.path.exists(self.offsets_path(digest))
+
+    def put(self, digest, pages):
+        # pages can be any iterable, e.g. a generator over a document being extracted
+        writer = self.writer(digest, resume=False)
+        try:
+            for page in pages:
+                writer.append(page)
+        except BaseException:
+            writer.close()
+            raise
+        writer.commit()
+
+    def writer(self, digest, resume=True, blocking=True):
+        # Only one writer per digest at a time, so two ingests of the same PDF (from different
+        # sessions or API requests) can't write over each other's partial file. Without blocking,
+        # returns None if another writer holds the digest.
+        with self.lock:
+            lock = self.writer_locks.setdefault(digest, threading.Lock())
+        if not lock.acquire(blocking):
+            return None
+        try:
+            return TextWriter(self, digest, resume, lock)
+        except BaseException:
+            lock.release()
+            raise
+
+    def write_file(self, path, data):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _open(self, digest):
+        with self.lock:
+            if digest in self.maps:
+                self.maps.move_to_end(digest)
+                return self.maps[digest]
+            with open(self.offsets_path(digest), "r") as f:
+                offsets = json.load(f)
+            with open(self.text_path(digest), "rb") as f:
+                text_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else None
+            self.maps[digest] = (text_map, offsets)
+            while len(self.maps) > self.open_files:
+                self.maps.popitem(last=False)  # Unmapped once no reader holds it
+            return self.maps[digest]
+
+    def read(self, digest, offset, size):
+        text_map, _ = self._open(digest)
+        if text_map is None:
+            return ""
+        return text_map[offset:offset + size].decode("utf-8", errors="replace")
+
+    def page_count(self, digest):
+        return len(self._open(digest)[1]) - 1
+
+    def read_page(self, digest, page_number):
+        # 1-based, like the page numbers chunks are labelled with
+        offsets = self._open(digest)[1]
+        return self.read(digest, offsets[page_number - 1], offsets[page_number] - offsets[page_number - 1] - 1)
+
+    def iter_pages(self, digest):
+        for page_number in range(1, self.page_count(digest) + 1):
+            yield self.read_page(digest, page_number)
+
+class TextWriter:
+    # Appends one document's pages to a TextStore. checkpoint() makes the pages written so far
+    # durable in <digest>.partial.json, and a later writer for the same digest resumes after the
+    # last checkpointed page, so an interrupted extraction doesn't start over. The document only
+    # becomes visible to exists() and readers once commit() has run.
+    def __init__(self, store, digest, resume=True, lock=None):
+        self.store = store
+        self.digest = digest
+        self.lock = lock  # The store's writer lock for the digest, released on commit or close
+        self.partial_path = f"{store.text_path(digest)}.partial"
+        self.offsets = [0]  # Byte offset of every page start plus the end, as in the .pages.json sidecar
+        if resume and os.path.exists(self.partial_path) and os.path.exists(store.checkpoint_path(digest)):
+            try:
+                with open(store.checkpoint_path(digest), "r") as f:
+                    self.offsets = json.load(f)["offsets"]
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Ignoring unreadable extraction checkpoint for {digest}: {str(e)}")
+                self.offsets = [0]
+        self.file = open(self.partial_path, "ab")
+        self.file.truncate(self.offsets[-1])  # Drops anything written after the last checkpoint
+
+    @property
+    def page_count(self):
+        return len(self.offsets) - 1
+
+    def reset(self):
+        # Starts the document over, e.g. when the checkpoint is from a different extraction
+        self.offsets = [0]
+        self.file.truncate(0)
+
+    def append(self, page):
+        data = normalize_page(page).encode("utf-8") + b"\n"
+        self.file.write(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+
+    def checkpoint(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.store.write_file(self.store.checkpoint_path(self.digest), json.dumps({"offsets": self.offsets}).encode("utf-8"))
+
+    def commit(self):
+        # The last page has no trailing newline. The text goes first and the offsets last, so
+        # exists() never sees a half-written entry.
+        self.file.truncate(max(0, self.offsets[-1] - 1))
+        self.file.close()
+        os.replace(self.partial_path, self.store.text_path(self.digest))
+        self.store.write_file(self.store.offsets_path(self.digest), json.dumps(self.offsets).encode("utf-8"))
+        if os.path.exists(self.store.checkpoint_path(self.digest)):
+            os.remove(self.store.checkpoint_path(self.digest))
+        with self.store.lock:
+            self.store.maps.pop(self.digest, None)
+        self._release()
+
+    def close(self):
+        # Stops writing without committing; pages up to the last checkpoint are kept for a resume
+        if not self.file.closed:
+            self.file.close()
+            if self.page_count == 0 and not os.path.exists(self.store.checkpoint_path(self.digest)):
+                os.remove(self.partial_path)  # Nothing to resume from
+        self._release()
+
+    def _release(self):
+        if self.lock is not None:
+            self.lock.release()
+            self.lock = None
@@ -0,0 +1,120 @@
+# vector_index.py
+
+import json
+import os
+import threading
+from contextlib import nullcontext
+import requests
+
+try:
+    import numpy as np
+except ImportError:  # Semantic retrieval is optional; keyword retrieval works without numpy
+    np = None
+
+def semantic_available():
+    return np is not None
+
+def ollama_embed(server, model, texts, batch_size=32):
+    # Embeds texts through Ollama's /api/embed endpoint, returning an (n, dim) float32 array
+    vectors = []
+    for start in range(0, len(texts), batch_size):
+        response = requests.post(f"{server}/api/embed", json={"model": model, "input": texts[start:start + batch_size]})
+        response.raise_for_status()
+        vectors.extend(response.json()["embeddings"])
+    return np.asarray(vectors, dtype=np.float32)
+
+class VectorIndex:
+    # Chunk embeddings for one profile, kept on disk as a float32 .npy matrix that is memory-mapped
+    # for queries. Row i belongs to chunk_ids[i] of the profile's BM25 index, and rows are
+    # L2-normalised when stored so cosine similarity is a single matrix-vector product.
+    def __init__(self, directory):
+        self.matrix_path = os.path.join(directory, "embeddings.npy")
+        self.meta_path = os.path.join(directory, "embeddings.json")
+        self.chunk_ids = []
+        self.rows = {}  # chunk_id -> matrix row
+        self.model = None
+        self.index_uid = None
+        self.matrix = None
+        self.lock = threading.Lock()  # Held by searches, and by a sync only while it swaps in a new matrix
+        self.sync_lock = threading.Lock()  # One sync at a time
+        if os.path.exists(self.matrix_path) and os.path.exists(self.meta_path):
+            with open(self.meta_path, "r") as f:
+                meta = json.load(f)
+            self.chunk_ids = meta["chunk_ids"]
+            self.rows = {chunk_id: row for row, chunk_id in enumerate(self.chunk_ids)}
+            self.model = meta["model"]
+            self.index_uid = meta.get("index_uid")
+            self.matrix = np.load(self.matrix_path, mmap_mode="r")
+
+    def sync(self, index, embed, model, index_lock=None):
+        # Brings the matrix in line with the BM25 index: rows of removed chunks are dropped and only
+        # chunks without an embedding yet are sent to the embedder. Returns the number embedded.
+        # index_lock, if given, is held while the chunk list is read but not while chunks are embedded,
+        # and self.lock only while the new matrix is swapped in, so searches never wait on the embedder.
+        with self.sync_lock:
+            new_vectors = {}  # chunk_id -> normalised embedding made by this sync, for new_vectors_uid
+            new_vectors_uid = None
+            embedded = 0
+            while True:
+                with index_lock if index_lock is not None else nullcontext():
+                    chunk_ids = index.retrievable_chunks()  # Chunks collapsed into a near-duplicate get no row
+                    index_uid = index.uid
+                    reusable = model == self.model and index_uid == self.index_uid  # Chunk ids restart in a rebuilt index
+                    if chunk_ids == self.chunk_ids and reusable:
+                        return embedded
+                    if index_uid != new_vectors_uid:
+                        new_vectors = {}
+                        new_vectors_uid = index_uid
+                    existing = self.rows if reusable else {}
+                    missing = [chunk_id for chunk_id in chunk_ids if chunk_id not in existing and chunk_id not in new_vectors]
+                    missing_chunks = [dict(index.chunks[chunk_id]) for chunk_id in missing]
+                if missing:
+                    vectors = embed([index.read_chunk(chunk) for chunk in missing_chunks])
+                    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+                    new_vectors.update(zip(missing, vectors))
+                    embedded += len(missing)
+                    continue  # Chunks may have been added or removed while these were embedded
+
+                dimension = len(next(iter(new_vectors.values()))) if new_vectors else self.matrix.shape[1] if self.matrix is not None else 0
+                os.makedirs(os.path.dirname(self.matrix_path), exist_ok=True)
+                tmp_path = f"{self.matrix_path}.tmp.npy"
+                matrix = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(len(chunk_ids), dimension))
+                for row, chunk_id in enumerate(chunk_ids):
+                    matrix[row] = self.matrix[existing[chunk_id]] if chunk_id in existing else new_vectors[chunk_id]
+                matrix.flush()
+                del matrix
+
+                with self.lock, index_lock if index_lock is not None else nullcontext():
+                    if index.retrievable_chunks() != chunk_ids or index.uid != index_uid:
+                        os.remove(tmp_path)
+                        continue  # The index changed while the matrix was written; go round again
+                    self.matrix = None
+                    os.replace(tmp_path, self.matrix_path)
+                    with open(self.meta_path, "w") as f:
+                        json.dump({"model": model, "index_uid": index_uid, "chunk_ids": chunk_ids}, f)
+                    self.chunk_ids = chunk_ids
+                    self.rows = {chunk_id: row for row, chunk_id in enumerate(chunk_ids)}
+                    self.model = model
+                    self.index_uid = index_uid
+                    self.matrix = np.load(self.matrix_path, mmap_mode="r")
+                    return embedded
+
+    def search(self, query_vector, top_k=1, lexical_scores=None, lexical_weight=0.0):
+        # Vectorised cosine top-k. With lexical_weight > 0, BM25 scores (scaled to 0..1) are fused in:
+        # score = (1 - w) * cosine + w * bm25 / max(bm25)
+        with self.lock:
+            if self.matrix is None or not len(self.chunk_ids):
+                return []
+            query_vector = np.asarray(query_vector, dtype=np.float32)
+            scores = self.matrix @ (query_vector / max(np.linalg.norm(query_vector), 1e-12))
+            if lexical_weight and lexical_scores:
+                lexical = np.zeros(len(self.chunk_ids), dtype=np.float32)
+                best = max(lexical_scores.values())
+                for chunk_id, score in lexical_scores.items():
+                    if chunk_id in self.rows:
+                        lexical[self.rows[chunk_id]] = score / best
+                scores = (1 - lexical_weight) * scores + lexical_weight * lexical
+            top_k = min(top_k, len(scores))
+            top = np.argpartition(-scores, top_k - 1)[:top_k]
+            top = top[np.argsort(-scores[top])]
+            return [(self.chunk_ids[row], float(scores[row])) for row in top]